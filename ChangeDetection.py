@@ -8,33 +8,404 @@ Creator: David Bucklin
 Functions to create and summarize changes in land cover over time.
 """
 from helper_arcpy import *
+import glob
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial, lru_cache
+import numpy as np
+try:
+   import rasterio
+   from rasterio.windows import Window
+except ImportError:
+   rasterio = None
+try:
+   from numba import njit, prange
+except ImportError:
+   njit = None
 
+# Number of cells processed at a time in array calculations, so intermediate arrays stay in CPU cache
+BLOCK_CELLS = 2 ** 20
 
-def change_rast(nlcd_t1, nlcd_t2, chg_rast, mask=None):
+
+def _row_blocks(shape):
+   """
+   Split an array into blocks of whole rows, of about BLOCK_CELLS cells each.
+   :param shape: Shape of the (2D) array
+   :return: generator of row slices
+   """
+   step = max(1, BLOCK_CELLS // shape[1])
+   for i in range(0, shape[0], step):
+      yield slice(i, i + step)
+
+
+@lru_cache(maxsize=None)
+def _describe(path):
+   """
+   Describe a dataset, caching the result for the process. Only use for inputs, which do not change while processing.
+   :param path: Dataset path
+   :return: Describe object
+   """
+   return arcpy.Describe(path)
+
+
+def _read_rast(rast):
+   """
+   Read a single-band raster to an array, with NoData as 0.
+   :param rast: Input raster
+   :return: array, and the georeferencing (lower left, cell width, cell height, spatial reference) for _write_rast
+   """
+   r = arcpy.Raster(rast)
+   geo = (r.extent.lowerLeft, r.meanCellWidth, r.meanCellHeight, r.spatialReference)
+   return arcpy.RasterToNumPyArray(r, nodata_to_value=0), geo
+
+
+def _write_rast(arr, geo, out_rast, nodata=0):
+   """
+   Write an array to a raster.
+   :param arr: Array to write
+   :param geo: Georeferencing, as returned by _read_rast
+   :param out_rast: Output raster
+   :param nodata: Array value to set to NoData
+   :return: out_rast
+   """
+   ll, cw, ch, sr = geo
+   arcpy.NumPyArrayToRaster(arr, ll, cw, ch, value_to_nodata=nodata).save(out_rast)
+   arcpy.DefineProjection_management(out_rast, sr)
+   return out_rast
+
+
+def make_mask_rast(mask, template, out_rast):
+   """
+   Rasterize mask polygons on the grid of a template raster, so the mask can be reused for multiple rasters.
+   :param mask: Mask polygons
+   :param template: Raster to use for coordinate system, cell size, and snapping
+   :param out_rast: Output mask raster
+   :return: out_rast
+   """
+   d = _describe(template)
+   with arcpy.EnvManager(outputCoordinateSystem=d.spatialReference, snapRaster=d.catalogPath, cellSize=d.meanCellWidth,
+                         extent=mask):
+      arcpy.PolygonToRaster_conversion(mask, _describe(mask).OIDFieldName, out_rast, cellsize=d.meanCellWidth)
+   return out_rast
+
+
+def _prep_mask(mask, template):
+   """
+   Get a mask raster, rasterizing mask polygons on the grid of the template raster (to 'tmp_mask') if needed.
+   :param mask: Mask, as polygons or a raster from make_mask_rast
+   :param template: Raster to use for coordinate system, cell size, and snapping
+   :return: mask raster, and whether it is temporary
+   """
+   if _describe(mask).dataType in ("FeatureClass", "FeatureLayer", "ShapeFile"):
+      return arcpy.Describe(make_mask_rast(mask, template, "tmp_mask")).catalogPath, True
+   return mask, False
+
+
+def _read_pair(nlcd_t1, nlcd_t2, mask=None):
+   """
+   Read land cover rasters from two time periods to aligned uint8 arrays (class values are below 100, see change_rast).
+   :param nlcd_t1: Land cover raster in time 1.
+   :param nlcd_t2: Land cover raster in time 2.
+   :param mask: Mask to apply (optional), as polygons or a raster from make_mask_rast. Its extent is used as the
+      processing window.
+   :return: t1 array, t2 array, boolean array of valid cells, and the georeferencing for _write_rast
+   """
+   if mask:
+      mask_rast, tmp_mask = _prep_mask(mask, nlcd_t1)
+      # a temporary mask is remade each time, so is not cached
+      ref = arcpy.Describe(mask_rast) if tmp_mask else _describe(mask_rast)
+   else:
+      ref = _describe(nlcd_t1)
+   ll, ncols, nrows = ref.extent.lowerLeft, ref.width, ref.height
+   geo = (ll, ref.meanCellWidth, ref.meanCellHeight, ref.spatialReference)
+   # no copy for 8-bit rasters
+   a1 = arcpy.RasterToNumPyArray(nlcd_t1, ll, ncols, nrows, nodata_to_value=0).astype(np.uint8, copy=False)
+   a2 = arcpy.RasterToNumPyArray(nlcd_t2, ll, ncols, nrows, nodata_to_value=0).astype(np.uint8, copy=False)
+   # NoData in either time period (or outside the mask) is not valid
+   valid = (a1 != 0) & (a2 != 0)
+   if mask:
+      valid &= arcpy.RasterToNumPyArray(mask_rast, ll, ncols, nrows, nodata_to_value=0) != 0
+      if tmp_mask:
+         arcpy.Delete_management(mask_rast)
+   return a1, a2, valid, geo
+
+
+def _gdal_path(rast):
+   """
+   Path to open a raster with rasterio. Rasters in a file geodatabase are opened with GDAL's OpenFileGDB driver
+   (requires GDAL 3.7+).
+   :param rast: Raster path
+   :return: path for rasterio.open
+   """
+   d, nm = os.path.split(rast)
+   if d.lower().endswith(".gdb"):
+      return "OpenFileGDB:" + d + ":" + nm
+   return rast
+
+
+def _rio_calc(fn, rasts, out_rast, dtype, nodata):
+   """
+   Calculate an output raster from input rasters with rasterio, reading and writing by window (strips of 512 rows).
+   The output has the grid of the first raster; other rasters must be aligned to it, and are read for the same bounds,
+   with areas outside them as 0. NoData in all inputs is read as 0.
+   :param fn: Function taking a list of arrays (one per input raster) and returning the output array
+   :param rasts: List of input rasters
+   :param out_rast: Output raster. If not a GeoTIFF, a temporary GeoTIFF is written and copied to out_rast.
+   :param dtype: Output data type
+   :param nodata: Output NoData value
+   :return: out_rast
+   """
+   if rasterio is None:
+      raise ImportError("rasterio is required for engine='rasterio'.")
+   if out_rast.lower().endswith(".tif"):
+      tif = out_rast
+   else:
+      tif = os.path.join(arcpy.env.scratchFolder, os.path.basename(out_rast) + ".tif")
+   srcs = [rasterio.open(_gdal_path(r)) for r in rasts]
+   ref = srcs[0]
+   prof = dict(driver="GTiff", width=ref.width, height=ref.height, count=1, dtype=dtype, nodata=nodata, crs=ref.crs,
+               transform=ref.transform, compress="lzw", tiled=True, blockxsize=512, blockysize=512, BIGTIFF="IF_SAFER")
+   try:
+      with rasterio.open(tif, "w", **prof) as dst:
+         for yo in range(0, ref.height, 512):
+            win = Window(0, yo, ref.width, min(512, ref.height - yo))
+            bounds = ref.window_bounds(win)
+            arrs = []
+            for src in srcs:
+               a = src.read(1, window=src.window(*bounds).round_offsets().round_lengths(), boundless=True,
+                            fill_value=0)
+               if src.nodata is not None:
+                  a[a == src.nodata] = 0
+               arrs.append(a)
+            dst.write(fn(arrs).astype(dtype, copy=False), 1, window=win)
+   finally:
+      for src in srcs:
+         src.close()
+   if tif != out_rast:
+      arcpy.CopyRaster_management(tif, out_rast)
+      arcpy.Delete_management(tif)
+   return out_rast
+
+
+def _combine(arrs):
+   """
+   Change values (t1*100 + t2) for blocks read by _rio_calc.
+   :param arrs: List of arrays: [mask (optional), t1, t2]
+   :return: uint16 array of change values, 0 (NoData) where any input is 0
+   """
+   out = arrs[-2].astype(np.uint16) * 100 + arrs[-1]
+   for a in arrs:
+      out[a == 0] = 0
+   return out
+
+
+def _rio_engine(fn, nlcd_t1, nlcd_t2, mask, out_rast, dtype, nodata):
+   """
+   Calculate an output raster from land cover rasters from two time periods with _rio_calc.
+   :param fn: Function taking the list of arrays [mask (optional), t1, t2], returning the output array
+   :param nlcd_t1: Land cover raster in time 1.
+   :param nlcd_t2: Land cover raster in time 2.
+   :param mask: Mask to apply (optional), as polygons or a raster from make_mask_rast. Its extent is used as the
+      processing window.
+   :param out_rast: Output raster
+   :param dtype: Output data type
+   :param nodata: Output NoData value
+   :return: out_rast
+   """
+   if not mask:
+      return _rio_calc(fn, [nlcd_t1, nlcd_t2], out_rast, dtype, nodata)
+   mask_rast, tmp_mask = _prep_mask(mask, nlcd_t1)
+   _rio_calc(fn, [mask_rast, nlcd_t1, nlcd_t2], out_rast, dtype, nodata)
+   if tmp_mask:
+      arcpy.Delete_management(mask_rast)
+   return out_rast
+
+
+def _summary_classes(sc, ec, start_cls, end_cls, backwards):
+   """
+   Assign change summary classes (see change_summary) to pairs of start/end class values.
+   :param sc: Array of start class values
+   :param ec: Array of end class values
+   :param start_cls: List of start classes
+   :param end_cls: List of end classes
+   :param backwards: whether to include classes identifying change from the end_cls to the start_cls.
+   :return: Array of summary classes
+   """
+   in_start_s, in_end_s = np.isin(sc, start_cls), np.isin(sc, end_cls)
+   in_start_e, in_end_e = np.isin(ec, start_cls), np.isin(ec, end_cls)
+   # conditions are evaluated in order; the first one met determines the class
+   conds = [in_start_s & in_start_e,
+            in_start_s & in_end_e,
+            in_start_s & ~(in_start_e | in_end_e),
+            in_end_s & in_start_e,
+            ~(in_start_s | in_end_s) & in_start_e]
+   return np.select(conds, [1, 2, 3, 4, 5 if backwards else 4], 0)
+
+
+if njit is not None:
+   @njit(parallel=True, cache=True)
+   def _recode_nb(a1, a2, valid, lut):
+      """
+      Compiled version of the change_pipeline reclassification: lut[t1*100 + t2] for valid cells, 255 (NoData)
+      elsewhere. Rows are processed in parallel, in one pass without intermediate arrays.
+      :param a1: t1 array
+      :param a2: t2 array
+      :param valid: boolean array of valid cells
+      :param lut: uint8 lookup table from change value to class
+      :return: uint8 array of classes
+      """
+      nrows, ncols = a1.shape
+      out = np.empty((nrows, ncols), np.uint8)
+      for i in prange(nrows):
+         for j in range(ncols):
+            if valid[i, j]:
+               out[i, j] = lut[a1[i, j] * 100 + a2[i, j]]
+            else:
+               out[i, j] = 255
+      return out
+
+
+def _area_fields(rast, perc_fld, perc_values=None):
+   """
+   Add area (hectares, for 30m cells) and percent area fields to a raster attribute table, calculated from cell counts.
+   :param rast: Raster with an attribute table
+   :param perc_fld: Name of the percent area field
+   :param perc_values: Values to calculate percentages for, relative to their total area (optional). Other rows are
+      left null. By default, percentages are calculated for all rows.
+   :return: rast
+   """
+   arr = arcpy.da.TableToNumPyArray(rast, ["Value", "Count"])
+   count = arr["Count"].astype(np.float64)
+   if perc_values is None:
+      # total from the integer counts, summed in C with a 64-bit accumulator (default int is 32-bit on Windows)
+      total = int(arr["Count"].sum(dtype=np.int64))
+      # percentages are 0 if there are no cells (empty table, or all NoData), rather than inf/NaN
+      perc = count / total * 100 if total else np.zeros_like(count)
+      out = np.rec.fromarrays([arr["Value"], count * 0.09, perc],
+                              names=["Value", "area_ha", perc_fld], formats=["<i4", "<f4", "<f4"])
+      arcpy.da.ExtendTable(rast, "Value", out, "Value")
+   else:
+      out = np.rec.fromarrays([arr["Value"], count * 0.09], names=["Value", "area_ha"], formats=["<i4", "<f4"])
+      arcpy.da.ExtendTable(rast, "Value", out, "Value")
+      sel = np.isin(arr["Value"], perc_values)
+      total = int(arr["Count"][sel].sum(dtype=np.int64))
+      perc = count[sel] / total * 100 if total else np.zeros_like(count[sel])
+      out = np.rec.fromarrays([arr["Value"][sel], perc],
+                              names=["Value", perc_fld], formats=["<i4", "<f4"])
+      arcpy.da.ExtendTable(rast, "Value", out, "Value")
+   return rast
+
+
+def _summary_attributes(out_rast, start_cls_nm, end_cls_nm, backwards, build_pyramids=True):
+   """
+   Build the attribute table for a change summary raster, and add class names, areas, and percentages.
+   :param out_rast: Change summary raster
+   :param start_cls_nm: Name to assign the start classes
+   :param end_cls_nm: Name to assign to the end classes
+   :param backwards: whether the raster includes classes identifying change from the end_cls the start_cls.
+   :param build_pyramids: Whether to build pyramids for the raster
+   :return: out_rast
+   """
+   arcpy.BuildRasterAttributeTable_management(out_rast, "OVERWRITE")
+   if build_pyramids:
+      arcpy.BuildPyramids_management(out_rast)
+   
+   print("Calculating attributes....")
+   # class names by value, made once rather than evaluated per row by the field calculator
+   sn, en = start_cls_nm, end_cls_nm
+   labels = {0: 'not ' + sn + ' in either time period',
+             1: sn + ' in both time periods',
+             2: sn + ' to ' + en,
+             3: sn + ' to non-' + en + ' class',
+             4: en + ' to ' + sn if backwards else 'non-' + sn + ' class to ' + sn,
+             5: 'non-' + en + ' class to ' + sn}
+   arcpy.AddField_management(out_rast, "class", "TEXT", field_length=255)
+   with arcpy.da.UpdateCursor(out_rast, ["Value", "class"]) as curs:
+      for r in curs:
+         curs.updateRow((r[0], labels.get(r[0])))
+
+   # Calculate stats
+   # percentages (only for rows which were start_cls in t1, so the percentages are relative to that time period).
+   _area_fields(out_rast, "perc_of_t1_area", perc_values=[1, 2, 3])
+   return out_rast
+
+
+def _cover_classes(rast):
+   """
+   Read the classes of a land cover raster.
+   :param rast: Land cover raster, with a 'CoverClass' attribute
+   :return: list of (value, class name)
+   """
+   return [(int(v), str(n)) for v, n in arcpy.da.TableToNumPyArray(rast, ["Value", "CoverClass"])]
+
+
+def _change_lookup(cls_t1, cls_t2):
+   """
+   Make the lookup of all possible combinations of classes in two time periods.
+   :param cls_t1: List of (value, class name) in time 1
+   :param cls_t2: List of (value, class name) in time 2
+   :return: dictionary of change value -> (start, start name, end, end name, change type)
+   """
+   lookup = {}
+   for v1, n1 in cls_t1:
+      for v2, n2 in cls_t2:
+         lookup[v1 * 100 + v2] = (v1, n1, v2, n2, "No change" if v1 == v2 else n1 + " to " + n2)
+   return lookup
+
+
+def build_class_lookup(in_gdb, yrs, suffix):
+   """
+   Make the change lookup once for a set of land cover rasters, for use with change_rast for any pair of them.
+   :param in_gdb: Geodatabase with input land cover rasters, named 'lc_[year]_[suffix]'
+   :param yrs: List of years
+   :param suffix: Input raster name suffix
+   :return: dictionary of change value -> (start, start name, end, end name, change type), for all classes in any year
+   """
+   cls = {}
+   for y in yrs:
+      cls.update(_cover_classes(in_gdb + os.sep + 'lc_' + y + "_" + suffix))
+   cls = sorted(cls.items())
+   return _change_lookup(cls, cls)
+
+
+def change_rast(nlcd_t1, nlcd_t2, chg_rast, mask=None, build_pyramids=True, engine="arcpy", lookup=None):
    '''
    Make a change raster using classified rasters from two time periods.
    :param nlcd_t1: Land cover raster in time 1.
    :param nlcd_t2: Land cover raster in time 2.
    :param chg_rast: Output change raster
    :param mask: Mask to apply (optional).
+   :param build_pyramids: Whether to build pyramids for the change raster. The attribute table is always built, since
+      attributes are added to it.
+   :param engine: 'arcpy' to read and write the full rasters as arrays with arcpy, or 'rasterio' to calculate the
+      raster by window with rasterio (see _rio_calc), which keeps memory use low for large rasters.
+   :param lookup: Change lookup from build_class_lookup (optional). By default, it is made from the classes of the
+      two rasters.
    :return: 
    '''
    print('Calculating changes...')
-   with arcpy.EnvManager(mask=mask, extent=mask, outputCoordinateSystem=nlcd_t1, snapRaster=nlcd_t1, cellSize=nlcd_t1):
-      rc = arcpy.sa.RasterCalculator([nlcd_t1, nlcd_t2], ["t1", "t2"], 'Int((t1*100) + t2)')
-      arcpy.sa.ExtractByMask(rc, mask).save(chg_rast)
+   if engine == "rasterio":
+      _rio_engine(_combine, nlcd_t1, nlcd_t2, mask, chg_rast, "uint16", 0)
+   else:
+      a1, a2, valid, geo = _read_pair(nlcd_t1, nlcd_t2, mask)
+      combined = np.empty(a1.shape, dtype=np.uint16)
+      for s in _row_blocks(a1.shape):
+         c = combined[s]
+         np.multiply(a1[s], 100, out=c, dtype=np.uint16)
+         c += a2[s]
+         # zero (NoData) where not valid
+         c *= valid[s]
+      del a1, a2, valid
+      _write_rast(combined, geo, chg_rast)
+      del combined
    print("Building attribute table...")
-   arcpy.BuildPyramids_management(chg_rast)
+   if build_pyramids:
+      arcpy.BuildPyramids_management(chg_rast)
    arcpy.BuildRasterAttributeTable_management(chg_rast, overwrite="OVERWRITE")
    # vals = [a[0] for a in arcpy.da.SearchCursor(chg_rast, ["Value"])]
   
-   # classes in either dataset
-   cls_t1 = [[a[0], a[1]] for a in arcpy.da.SearchCursor(nlcd_t1, ["Value", "CoverClass"])]
-   cls_t2 = [[a[0], a[1]] for a in arcpy.da.SearchCursor(nlcd_t2, ["Value", "CoverClass"])]
-   # Create list with all possible combination of values
-   cls = []
-   for c in cls_t1:
-      [cls.append([int(c[0]*100) + int(i[0]), c, i]) for i in cls_t2]
+   # Lookup of all possible combinations of classes in either dataset
+   if lookup is None:
+      lookup = _change_lookup(_cover_classes(nlcd_t1), _cover_classes(nlcd_t2))
    # Add fields
    arcpy.AddField_management(chg_rast, "change_type", "TEXT", field_length=100)
    arcpy.AddField_management(chg_rast, "start_class", field_type="Short")
@@ -44,22 +415,15 @@ def change_rast(nlcd_t1, nlcd_t2, chg_rast, mask=None):
    # Calculate fields
    with arcpy.da.UpdateCursor(chg_rast, ["Value", "start_class", "start_class_name", "end_class", "end_class_name", "change_type"]) as curs:
       for r in curs:
-         v = [i for i in cls if i[0] == r[0]][0]
-         r[1], r[2], r[3], r[4] = v[1][0], v[1][1], v[2][0], v[2][1]
-         if r[1] != r[3]:
-            r[5] = r[2] + " to " + r[4]
-         else:
-            r[5] = "No change"
-         curs.updateRow(r)
+         curs.updateRow((r[0],) + lookup[r[0]])
    # Calculate area / percentages
-   arcpy.CalculateField_management(chg_rast, "area_ha", "(!Count! * 900) / 10000", field_type="Float")
-   total_cells = sum([int(a[0]) for a in arcpy.da.SearchCursor(chg_rast, ["Count"])])
-   arcpy.CalculateField_management(chg_rast, "perc_total", "(!Count! / " + str(total_cells) + ") * 100", field_type="Float")
+   _area_fields(chg_rast, "perc_total")
    print("Done.")
    return chg_rast
 
 
-def change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, backwards=True):
+def change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, backwards=True,
+                   build_pyramids=True, engine="arcpy"):
    """
    From the change-detection raster, create a classified raster showing change from start_cls to end_cls.
    :param chg_rast: Change raster, created by 'change_detection_rast' function.
@@ -69,6 +433,8 @@ def change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_r
    :param end_cls_nm: Name to assign to the end classes
    :param out_rast: Output raster
    :param backwards: whether to include a classes identifying change from the end_cls the start_cls.
+   :param build_pyramids: Whether to build pyramids for the output raster
+   :param engine: 'arcpy' or 'rasterio' (see change_rast)
    The output raster can potentially have 6 classes, including:
       0: Not part of start_cls for either time period
       1: In start_cls for both time periods (no change)
@@ -80,72 +446,79 @@ def change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_r
    :return: chg_rast
    """
    print("Creating reclassification table...")
-   comb_class = start_cls + end_cls
-   arcpy.CopyRows_management(chg_rast, "tmp_tab")
-   arcpy.AddField_management("tmp_tab", "reclass", "SHORT")
-   with arcpy.da.UpdateCursor("tmp_tab", ["start_class", "end_class", "reclass"]) as curs:
-      for r in curs:
-         sc = r[0]
-         ec = r[1]
-         if sc in start_cls and ec in start_cls:
-            r[2] = 1
-         elif sc in start_cls and ec in end_cls:
-            r[2] = 2
-         elif sc in start_cls and ec not in comb_class:
-            r[2] = 3
-         elif sc in end_cls and ec in start_cls:
-            r[2] = 4
-         elif sc not in comb_class and ec in start_cls:
-            if backwards:
-               r[2] = 5
-            else:
-               r[2] = 4
-         else:
-            r[2] = 0
-         curs.updateRow(r)
+   arr = arcpy.da.TableToNumPyArray(chg_rast, ["Value", "start_class", "end_class"])
+   rc = _summary_classes(arr["start_class"], arr["end_class"], start_cls, end_cls, backwards)
    print("Reclassifying change detection raster...")
-   arcpy.sa.ReclassByTable(chg_rast, "tmp_tab", "Value", "Value", "reclass").save(out_rast)
-   arcpy.BuildRasterAttributeTable_management(out_rast, "OVERWRITE")
-   arcpy.BuildPyramids_management(out_rast)
-   
-   print("Calculating attributes....")
-   codeblock = '''def fn(val, sn, en, bw):
-      if val == 0:
-         return 'not ' + sn + ' in either time period'
-      elif val == 1:
-         return sn + ' in both time periods'
-      elif val == 2:
-         return sn + ' to ' + en
-      elif val == 3:
-         return sn + ' to non-' + en + ' class'
-      elif val == 4:
-         if bw:
-            return en + ' to ' + sn
-         else:
-            return 'non-' + sn + ' class to ' + sn
-      elif val == 5:
-         return 'non-' + en + ' class to ' + sn
-   '''
-   fn_call = "fn(!Value!,'" + start_cls_nm + "','" + end_cls_nm + "'," + str(backwards) + ")"
-   arcpy.CalculateField_management(out_rast, "class", fn_call, code_block=codeblock, field_type="TEXT")
+   # lookup table from change value to class; values not in the table (including NoData) are 255 (NoData)
+   lut = np.full(int(arr["Value"].max()) + 1, 255, dtype=np.uint8)
+   lut[arr["Value"]] = rc
+   if engine == "rasterio":
+      _rio_calc(lambda arrs: lut[arrs[0]], [chg_rast], out_rast, "uint8", 255)
+   else:
+      chg_arr, geo = _read_rast(chg_rast)
+      _write_rast(lut[chg_arr], geo, out_rast, nodata=255)
+      del chg_arr
+   _summary_attributes(out_rast, start_cls_nm, end_cls_nm, backwards, build_pyramids)
+   print("Done.")
+   return out_rast
 
-   # Calculate stats
-   arcpy.CalculateField_management(out_rast, "area_ha", "(!Count! * 900) / 10000", field_type="Float")
-   # percentages (only for rows which were start_cls in t1, so the percentages are relative to that time period).
-   tab = arcpy.MakeTableView_management(out_rast, where_clause="Value IN (1, 2, 3)")
-   total_cells = sum([int(a[0]) for a in arcpy.da.SearchCursor(tab, ["Count"])])
-   arcpy.CalculateField_management(tab, "perc_of_t1_area", "(!Count! / " + str(total_cells) + ") * 100", field_type="Float")
+
+def change_pipeline(nlcd_t1, nlcd_t2, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, mask=None, backwards=True,
+                    build_pyramids=True, engine="arcpy"):
+   """
+   Create the change summary raster (see change_summary) directly from the land cover rasters, without
+   writing the intermediate change raster. Each raster is read once, and the output is written once.
+   :param nlcd_t1: Land cover raster in time 1.
+   :param nlcd_t2: Land cover raster in time 2.
+   :param start_cls: List of start classes to identify change from (and optionally to)
+   :param start_cls_nm: Name to assign the start classes
+   :param end_cls: List of end classes, where changes from start to end (and optionally end to start) will be identified
+   :param end_cls_nm: Name to assign to the end classes
+   :param out_rast: Output raster
+   :param mask: Mask to apply (optional).
+   :param backwards: whether to include a classes identifying change from the end_cls the start_cls.
+   :param build_pyramids: Whether to build pyramids for the output raster
+   :param engine: 'arcpy' or 'rasterio' (see change_rast)
+   :return: out_rast
+   """
+   print("Creating reclassification table...")
+   # lookup table from every possible change value (t1*100 + t2) to class; 255 is NoData
+   sc, ec = np.divmod(np.arange(10000), 100)
+   lut = _summary_classes(sc, ec, start_cls, end_cls, backwards).astype(np.uint8)
+   # 0 only occurs for invalid cells (t1 is NoData), so it is used as the index for all invalid cells
+   lut[0] = 255
+   print("Calculating and reclassifying changes...")
+   if engine == "rasterio":
+      _rio_engine(lambda arrs: lut[_combine(arrs)], nlcd_t1, nlcd_t2, mask, out_rast, "uint8", 255)
+   else:
+      a1, a2, valid, geo = _read_pair(nlcd_t1, nlcd_t2, mask)
+      if njit is not None:
+         out = _recode_nb(a1, a2, valid, lut)
+      else:
+         out = np.empty(a1.shape, dtype=np.uint8)
+         # by block of rows, so the change values are never held for the full raster
+         for s in _row_blocks(a1.shape):
+            idx = a1[s].astype(np.uint16) * 100
+            idx += a2[s]
+            idx *= valid[s]
+            out[s] = lut[idx]
+         del idx
+      del a1, a2, valid
+      _write_rast(out, geo, out_rast, nodata=255)
+      del out
+   _summary_attributes(out_rast, start_cls_nm, end_cls_nm, backwards, build_pyramids)
    print("Done.")
    return out_rast
 
 
-def change_to_from(chg_rast, start_cls, start_cls_nm, out_rast):
+def change_to_from(chg_rast, start_cls, start_cls_nm, out_rast, build_pyramids=True):
    """
    From the change-detection raster, create a classified raster showing change from start_cls to end_cls.
    :param chg_rast: Change raster, created by 'change_detection_rast' function.
    :param start_cls: List of start classes to identify change from (and optionally to)
    :param start_cls_nm: Name to assign the start classes
    :param out_rast: Output raster
+   :param build_pyramids: Whether to build pyramids for the output raster
    The output raster can potentially have 6 classes, including:
       0: Not part of start_cls for either time period
       1: In start_cls for both time periods (no change)
@@ -160,27 +533,33 @@ def change_to_from(chg_rast, start_cls, start_cls_nm, out_rast):
    arcpy.CopyRows_management(chg_rast, "tmp_tab")
    arcpy.AddField_management("tmp_tab", "reclass", "LONG")
    repl = str(start_cls[0])
+   repl_i = int(repl)
+   start_set = frozenset(start_cls)
+   both_nm = start_cls_nm + " both time periods"
+   neither_nm = "Not " + start_cls_nm + " either time period"
    
    with arcpy.da.UpdateCursor("tmp_tab", ["start_class", "start_class_name", "end_class", "end_class_name", "reclass", "Value", "change_type"]) as curs:
       for r in curs:
          sc = r[0]
          ec = r[2]
-         if sc in start_cls:
-            if ec in start_cls:
+         sc_in = sc in start_set
+         ec_in = ec in start_set
+         if sc_in:
+            if ec_in:
                # no change
                r[4] = 1
-               r[6] = start_cls_nm + " both time periods"
+               r[6] = both_nm
             else:
                # change from target
-               r[0] = int(repl)
+               r[0] = repl_i
                r[1] = start_cls_nm
                # make new change class
                r[4] = int(repl + str(ec))
                r[6] = start_cls_nm + " to " + r[3]
          else:
-            if ec in start_cls:
+            if ec_in:
                # change to target
-               r[2] = int(repl)
+               r[2] = repl_i
                r[3] = start_cls_nm
                # make new change class
                r[4] = int(str(sc) + repl)
@@ -188,21 +567,26 @@ def change_to_from(chg_rast, start_cls, start_cls_nm, out_rast):
             else:
                # not part of target class either period
                r[4] = 0
-               r[6] = "Not " + start_cls_nm + " either time period"
+               r[6] = neither_nm
          curs.updateRow(r)
    arcpy.CopyRows_management("tmp_tab", out_rast + 'tab')
    print("Reclassifying change detection raster...")
-   arcpy.sa.ReclassByTable(chg_rast, "tmp_tab", "Value", "Value", "reclass").save(out_rast)
+   # lookup table from change value to the new change class; values not in the table (including NoData) are NoData
+   arr = arcpy.da.TableToNumPyArray("tmp_tab", ["Value", "reclass"])
+   lut = np.full(int(arr["Value"].max()) + 1, 65535, dtype=np.uint16)
+   lut[arr["Value"]] = arr["reclass"]
+   chg_arr, geo = _read_rast(chg_rast)
+   _write_rast(lut[chg_arr], geo, out_rast, nodata=65535)
+   del chg_arr
    arcpy.BuildRasterAttributeTable_management(out_rast, "OVERWRITE")
-   arcpy.BuildPyramids_management(out_rast)
+   if build_pyramids:
+      arcpy.BuildPyramids_management(out_rast)
    # join new name
    flds = ['change_type']
    arcpy.JoinField_management(out_rast, "Value", "tmp_tab", "reclass", flds)
 
    # Calculate stats
-   arcpy.CalculateField_management(out_rast, "area_ha", "(!Count! * 900) / 10000", field_type="Float")
-   total_cells = sum([int(a[0]) for a in arcpy.da.SearchCursor(out_rast, ["Count"])])
-   arcpy.CalculateField_management(out_rast, "perc_area", "(!Count! / " + str(total_cells) + ") * 100", field_type="Float")
+   _area_fields(out_rast, "perc_area")
    # Copy table
    arcpy.CopyRows_management(out_rast, out_rast + "_tab")
    
@@ -210,58 +594,116 @@ def change_to_from(chg_rast, start_cls, start_cls_nm, out_rast):
    return out_rast
 
 
-# Run process
-out_gdb = r'C:\David\proc\NLCD_chg\nlcd2019ed_changeDetection.gdb'
-arcpy.env.workspace = out_gdb  # "in_memory"  # headsup: don't use memory as workspace. Can cause issues with masking.
-arcpy.env.overwriteOutput = True
-make_gdb(out_gdb)
-in_gdb = r'C:\David\proc\NLCD_chg\nlcd_2019ed_LandCover_albers_rclsBarrens.gdb'
-# change_prod = in_gdb + os.sep + "nlcd_changeproduct_2001_2019"
-mask = r"D:\projects\GIS_Data\Reference_Data.gdb\VirginiaCounty_dissolved"
-
-# Set up year combinations
-# yr_all = ['2001', '2004', '2006', '2008', '2011', '2013', '2016', '2019']
-# yr_pairs = [[yr_all[i], yr_all[i+1]] for i in list(range(0, len(yr_all)-1))] + [[yr_all[0], yr_all[len(yr_all)-1]]]
-yr_pairs = [['2001', '2021'], ['2001', '2011'], ['2011', '2021']]  # manual setting
-# yr_pairs = [['2001', '2011']]
-
-# Settings for General reclass change summary
-# Find differences for Natural->developed
-start_cls = [4]
-end_cls = [2]
-start_cls_nm = "Natural"
-end_cls_nm = "Developed"
-suffix = '_rclsGeneral'
-chg_nm = "lc_allChangeGeneral"
-summ_nm = "chg_nat_dev"
-
-## Settings for All NLCD class change summary
-# Find differences for Forest->developed
-start_cls = [41, 42, 43, 52, 90]  # note the derived forest change classes are 56 (shrub/scrub), 75 (herbaceous)
-start_cls_nm = "Forest"
-end_cls = [21, 22, 23, 24, 32]
-end_cls_nm = "Developed"
-# Input raster name pattern
-suffix = "rclsBarrens"  # rclsBarrens | rclsFor
-# Output rasters name pattern
-if suffix == "rclsBarrens":
-   chg_nm = "lc_allChange"
-   summ_nm = "chg_forest_dev"
-else:
-   chg_nm = "lc_allChangeFor"
-   summ_nm = "chgFor_forest_dev"
-
-# Run change summary
-for y in yr_pairs:
+def process_pair(y, in_gdb, out_gdb, mask, suffix, chg_nm, summ_nm, start_cls, start_cls_nm, end_cls, end_cls_nm,
+                 keep_chg_rast=True, engine="arcpy", lookup=None):
+   """
+   Make the change raster (optional) and change summary raster for one pair of years. Temporary datasets are written
+   to a scratch geodatabase for the process, so that pairs can be processed in parallel.
+   :param y: List of [year 1, year 2]
+   :param in_gdb: Geodatabase with input land cover rasters, named 'lc_[year]_[suffix]'
+   :param out_gdb: Geodatabase for output rasters
+   :param mask: Mask to apply (optional), as polygons or a raster from make_mask_rast.
+   :param suffix: Input raster name suffix
+   :param chg_nm: Output change raster name prefix
+   :param summ_nm: Output change summary raster name prefix
+   :param start_cls: List of start classes (see change_summary)
+   :param start_cls_nm: Name to assign the start classes
+   :param end_cls: List of end classes (see change_summary)
+   :param end_cls_nm: Name to assign to the end classes
+   :param keep_chg_rast: Whether to make the full change raster. If False, the change summary is made directly from the
+      land cover rasters, unless the change raster already exists.
+   :param engine: 'arcpy' or 'rasterio' (see change_rast)
+   :param lookup: Change lookup from build_class_lookup (optional, see change_rast)
+   :return: out_rast
+   """
    y1 = y[0]
    y2 = y[1]
    print("Working on " + y1 + " to " + y2 + "...")
+   scratch_gdb = out_gdb.replace(".gdb", "_w" + str(os.getpid()) + ".gdb")
+   make_gdb(scratch_gdb)
+   arcpy.env.workspace = scratch_gdb  # headsup: don't use memory as workspace. Can cause issues with masking.
+   arcpy.env.overwriteOutput = True
    nlcd_t1 = in_gdb + os.sep + 'lc_' + y1 + "_" + suffix
    nlcd_t2 = in_gdb + os.sep + 'lc_' + y2 + "_" + suffix
    chg_rast = out_gdb + os.sep + chg_nm + "_" + y1 + "_" + y2
-   if not arcpy.Exists(chg_rast):
-      change_rast(nlcd_t1, nlcd_t2, chg_rast, mask)
    out_rast = out_gdb + os.sep + summ_nm + "_" + y1 + "_" + y2
-   change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, backwards=False)
+   if keep_chg_rast or arcpy.Exists(chg_rast):
+      if not arcpy.Exists(chg_rast):
+         change_rast(nlcd_t1, nlcd_t2, chg_rast, mask, build_pyramids=False, engine=engine, lookup=lookup)
+      change_summary(chg_rast, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, backwards=False, engine=engine)
+   else:
+      change_pipeline(nlcd_t1, nlcd_t2, start_cls, start_cls_nm, end_cls, end_cls_nm, out_rast, mask, backwards=False,
+                      engine=engine)
+   return out_rast
+
+
+def main():
+   out_gdb = r'C:\David\proc\NLCD_chg\nlcd2019ed_changeDetection.gdb'
+   arcpy.env.overwriteOutput = True
+   make_gdb(out_gdb)
+   in_gdb = r'C:\David\proc\NLCD_chg\nlcd_2019ed_LandCover_albers_rclsBarrens.gdb'
+   # change_prod = in_gdb + os.sep + "nlcd_changeproduct_2001_2019"
+   mask = r"D:\projects\GIS_Data\Reference_Data.gdb\VirginiaCounty_dissolved"
+
+   # Set up year combinations
+   # yr_all = ['2001', '2004', '2006', '2008', '2011', '2013', '2016', '2019']
+   # yr_pairs = [[yr_all[i], yr_all[i+1]] for i in list(range(0, len(yr_all)-1))] + [[yr_all[0], yr_all[len(yr_all)-1]]]
+   yr_pairs = [['2001', '2021'], ['2001', '2011'], ['2011', '2021']]  # manual setting
+   # yr_pairs = [['2001', '2011']]
+
+   # Settings for General reclass change summary
+   # Find differences for Natural->developed
+   start_cls = [4]
+   end_cls = [2]
+   start_cls_nm = "Natural"
+   end_cls_nm = "Developed"
+   suffix = '_rclsGeneral'
+   chg_nm = "lc_allChangeGeneral"
+   summ_nm = "chg_nat_dev"
+
+   ## Settings for All NLCD class change summary
+   # Find differences for Forest->developed
+   start_cls = [41, 42, 43, 52, 90]  # note the derived forest change classes are 56 (shrub/scrub), 75 (herbaceous)
+   start_cls_nm = "Forest"
+   end_cls = [21, 22, 23, 24, 32]
+   end_cls_nm = "Developed"
+   # Input raster name pattern
+   suffix = "rclsBarrens"  # rclsBarrens | rclsFor
+   # Output rasters name pattern
+   if suffix == "rclsBarrens":
+      chg_nm = "lc_allChange"
+      summ_nm = "chg_forest_dev"
+   else:
+      chg_nm = "lc_allChangeFor"
+      summ_nm = "chgFor_forest_dev"
+   # Whether to make the full change raster (all class combinations). If False, change summaries are made directly from
+   # the land cover rasters, unless the change raster already exists.
+   keep_chg_rast = True
+   # Raster calculation engine: 'arcpy' (full arrays) or 'rasterio' (by window, requires rasterio with GDAL 3.7+)
+   engine = "arcpy"
+
+   # Rasterize the mask once, for use with all year pairs
+   mask_rast = out_gdb + os.sep + "va_mask"
+   if not arcpy.Exists(mask_rast):
+      make_mask_rast(mask, in_gdb + os.sep + 'lc_' + yr_pairs[0][0] + "_" + suffix, mask_rast)
+   # Change lookup for all years, made once and shared by all year pairs
+   lookup = build_class_lookup(in_gdb, sorted(set(y for p in yr_pairs for y in p)), suffix) if keep_chg_rast else None
+
+   # Run change summary. Year pairs are independent, so they are processed in parallel (one process per pair).
+   workers = min(len(yr_pairs), max(1, os.cpu_count() // 2))
+   run = partial(process_pair, in_gdb=in_gdb, out_gdb=out_gdb, mask=mask_rast, suffix=suffix, chg_nm=chg_nm,
+                 summ_nm=summ_nm, start_cls=start_cls, start_cls_nm=start_cls_nm, end_cls=end_cls,
+                 end_cls_nm=end_cls_nm, keep_chg_rast=keep_chg_rast, engine=engine,
+                 lookup=lookup)
+   with ProcessPoolExecutor(max_workers=workers) as ex:
+      for out_rast in ex.map(run, yr_pairs):
+         print("Finished " + out_rast + ".")
+   # Remove the scratch geodatabases of the worker processes
+   for g in glob.glob(out_gdb.replace(".gdb", "_w*.gdb")):
+      arcpy.Delete_management(g)
+
+
+if __name__ == '__main__':
+   main()
 
 # end
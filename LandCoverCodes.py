@@ -0,0 +1,58 @@
+# ---------------------------------------------------------------------------
+# LandCoverCodes.py
+# Version:  ArcGIS Pro / Python 3.x
+# Creation Date: 2026-10-14
+
+# Usage notes: Land cover code tables shared by LandscapeChange and LandscapePlots. This only needs numpy, so it can
+# be imported without arcpy (e.g. by LandscapePlots, which imports arcpy only when it is used).
+# ---------------------------------------------------------------------------
+
+import numpy as np
+
+def buildLut(rclsTab):
+   '''Builds a lookup table (uint8 array of 256 values, indexed by code) from a reclassification table string, as used by the Reclassify tool. NODATA is 0, and codes not in the table are unchanged (as with Reclassify "DATA").
+   
+   Parameters:
+   - rclsTab: reclassification table, as "old new;old new;...". New values can be NODATA.
+   '''
+   lut = np.arange(256, dtype=np.uint8)
+   for pair in rclsTab.split(";"):
+      k, v = pair.split()
+      if v != "NODATA":
+         lut[int(k)] = int(v)
+   return lut
+
+# Lookup table from NLCD codes to general land cover codes (see LandscapeChange.reclassGeneral). Includes forest-change added classes.
+# GEN_LUT = buildLut("0 NODATA;11 1;21 2;22 2;23 2;24 2; 31 4;32 2;41 4;42 4;43 4;52 5;71 5;81 3;82 3;90 4;95 4")
+GEN_LUT = buildLut("0 NODATA;11 1;21 2;22 2;23 2;24 2;31 4;32 2;41 4;42 4;43 4;52 5;56 5;71 5;75 6;81 3;82 3;90 4;95 4")
+
+# Cover class names, by code (see LandscapeChange.addCoverClass)
+NLCD_COVER = {0: "Unclassified",
+              11: "Open Water",
+              21: "Developed, Open Space",
+              22: "Developed, Low Intensity",
+              23: "Developed, Medium Intensity",
+              24: "Developed, High Intensity",
+              31: "Barren, Natural",
+              32: "Barren, Anthropogenic",
+              41: "Deciduous Forest",
+              42: "Evergreen Forest",
+              43: "Mixed Forest",
+              # 45: "Deciduous Forest - Silviculture",
+              # 46: "Evergreen Forest - Silviculture",
+              # 47: "Mixed Forest - Silviculture",
+              52: "Shrub/Scrub",
+              56: "Shrub/Scrub successional",
+              71: "Herbaceous",
+              75: "Harvested/Disturbed",
+              81: "Hay/Pasture",
+              82: "Cultivated Crops",
+              90: "Woody Wetlands",
+              95: "Emergent Herbaceous Wetlands"}
+GEN_COVER = {0: "Undefined",
+             1: "Open Water",
+             2: "Developed",
+             3: "Agriculture",
+             4: "Natural",
+             5: "Successional",
+             6: "Harvested/Disturbed"}  # This is Herbaceous which is in the Forest Change class in the change product
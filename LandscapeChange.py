@@ -11,9 +11,132 @@
 # Import modules and functions
 from helper_arcpy import *
 from Helper import *
+from LandCoverCodes import buildLut, GEN_LUT, NLCD_COVER, GEN_COVER
 from arcpy.sa import *
+import glob
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial, reduce, lru_cache
+import numpy as np
+import pandas as pd
+from scipy import ndimage
+try:
+   from numba import njit, prange
+except ImportError:
+   njit = None
 arcpy.CheckOutExtension("Spatial")
 
+# Lookup tables from reference raster codes to the likeliest barren type (31 or 32), by schema of the reference raster
+# (see reclassBarren)
+REF_RCLS_LUT = {"1992": buildLut("0 NODATA;11 31;21 32;22 32;23 32;31 31;32 32;33 32;41 32;42 32;43 32;51 32;61 32;71 32;81 32;82 32;83 32;84 32;85 32;91 31;92 31"),
+                "standard": buildLut("0 NODATA;11 31;21 32;22 32;23 32;24 32; 31 31;32 32;41 32;42 32;43 32;52 32;71 32;81 32;82 32;90 31;95 31")}
+
+def _majority3x3(a):
+   '''Applies a 3x3 majority filter to an array of 31/32 codes, ignoring NoData (0), as with FocalStatistics MAJORITY/DATA. Ties go to the lower value (31). Cells with no data in the window are 0.
+   
+   Parameters:
+   - a: uint8 array of 31, 32, or 0 (NoData)
+   '''
+   if njit is not None:
+      return _majority3x3_nb(a)
+   win = np.ones((3, 3), dtype=np.uint8)
+   n31 = ndimage.convolve((a == 31).view(np.uint8), win, mode="constant")
+   n32 = ndimage.convolve((a == 32).view(np.uint8), win, mode="constant")
+   out = np.where(n31 >= n32, 31, 32).astype(np.uint8)
+   out[(n31 == 0) & (n32 == 0)] = 0
+   return out
+
+if njit is not None:
+   @njit(parallel=True, cache=True)
+   def _majority3x3_nb(a):
+      '''Compiled version of _majority3x3: counts the two classes in each window in one pass, with rows in parallel.'''
+      nrows, ncols = a.shape
+      out = np.zeros((nrows, ncols), np.uint8)
+      for i in prange(nrows):
+         for j in range(ncols):
+            c31 = 0
+            c32 = 0
+            for di in range(max(i - 1, 0), min(i + 2, nrows)):
+               for dj in range(max(j - 1, 0), min(j + 2, ncols)):
+                  v = a[di, dj]
+                  if v == 31:
+                     c31 += 1
+                  elif v == 32:
+                     c32 += 1
+            if c31 + c32 > 0:
+               out[i, j] = 31 if c31 >= c32 else 32
+      return out
+
+def _readArrays(rasts, template):
+   '''Reads rasters to arrays on the grid of a template raster, with NoData as 0.
+   
+   Parameters:
+   - rasts: list of rasters to read (aligned with the template)
+   - template: raster defining the processing window
+   
+   Returns the list of arrays, and the georeferencing (lower left, cell width, cell height, spatial reference) for _writeArray.
+   '''
+   d = arcpy.Describe(template)
+   ll = d.extent.lowerLeft
+   arrs = [arcpy.RasterToNumPyArray(r, ll, d.width, d.height, nodata_to_value=0) for r in rasts]
+   return arrs, (ll, d.meanCellWidth, d.meanCellHeight, d.spatialReference)
+
+def _writeArray(arr, geo, outRast, nodata=0):
+   '''Writes an array to a raster, and builds its attribute table.
+   
+   Parameters:
+   - arr: array to write
+   - geo: georeferencing, as returned by _readArrays
+   - outRast: output raster
+   - nodata: array value to set to NoData
+   '''
+   ll, cw, ch, sr = geo
+   arcpy.NumPyArrayToRaster(arr, ll, cw, ch, nodata).save(outRast)
+   arcpy.DefineProjection_management(outRast, sr)
+   arcpy.BuildRasterAttributeTable_management(outRast, "OVERWRITE")
+   return outRast
+
+# Number of reference raster blocks to cache (see _refBarren); each is up to one uint8 block (with margins), ~16 MB
+REF_CACHE_SIZE = 4
+
+def _blockedApply(rasts, outRasts, fn, halo = 0, block = BLOCK_SIZE):
+   '''Applies an array function to rasters, block by block for rasters larger than one block, so memory use is bounded. Each block is read with a margin of halo cells (clipped to the raster) for neighborhood operations, which is trimmed from the result. Blocks are written to temporary rasters in the workspace and mosaicked to the outputs.
+   
+   Parameters:
+   - rasts: list of input rasters. The first raster defines the processing window; others must be aligned with it.
+   - outRasts: list of output rasters
+   - fn: function taking the list of input arrays for a block (NoData as 0) and the block's read window (x and y of the lower left corner, number of columns, number of rows), returning a list of output arrays (one per output raster, NoData as 0)
+   - halo: number of cells to add around each block. Must be at least the reach of any neighborhood operation in fn.
+   - block: block size, in cells
+   '''
+   d = arcpy.Describe(rasts[0])
+   ncols, nrows = d.width, d.height
+   if ncols <= block and nrows <= block:
+      arrs, geo = _readArrays(rasts, rasts[0])
+      for arr, outRast in zip(fn(arrs, (geo[0].X, geo[0].Y, ncols, nrows)), outRasts):
+         _writeArray(arr, geo, outRast)
+      return outRasts
+   
+   cw, ch = d.meanCellWidth, d.meanCellHeight
+   tiles = [[] for o in outRasts]
+   for i, j, h, w, ll, i0, j0, rll, rcols, rrows in blockWindows(d, block, halo):
+      printMsg('Processing block at row %s, column %s...'%(i, j))
+      win = (rll.X, rll.Y, rcols, rrows)
+      arrs = [arcpy.RasterToNumPyArray(r, rll, rcols, rrows, nodata_to_value=0) for r in rasts]
+      for k, arr in enumerate(fn(arrs, win)):
+         tile = "tmp_blk%s_%s_%s"%(k, i, j)
+         arcpy.NumPyArrayToRaster(np.ascontiguousarray(arr[i - i0:i - i0 + h, j - j0:j - j0 + w]), ll, cw, ch, 0).save(tile)
+         tiles[k].append((tile, arr.dtype.name))
+      del arrs
+   for k, outRast in enumerate(outRasts):
+      printMsg('Mosaicking blocks to %s...'%outRast)
+      arcpy.MosaicToNewRaster_management([t[0] for t in tiles[k]], os.path.dirname(outRast), os.path.basename(outRast), d.spatialReference, PIXEL_TYPES[tiles[k][0][1]], cw, 1)
+      for t in tiles[k]:
+         arcpy.Delete_management(t[0])
+      # the mosaic does not keep the blocks' NoData value (0), so it is set on the output
+      arcpy.SetRasterProperties_management(outRast, nodata="1 0")
+      arcpy.BuildRasterAttributeTable_management(outRast, "OVERWRITE")
+   return outRasts
+
 def addCoverClass(inTab, schema):
    '''To input table, adds a field indicating cover classes for each code in the "Value" field.
    
@@ -21,55 +144,34 @@ def addCoverClass(inTab, schema):
    - inTab: input table (can be a standalone table or a standalone table)
    - schema: NLCD or Gen (general) codes [may want to add additional schemas at some point]
    '''
-   if schema == "NLCD":
-      codeblock = '''def covClass(val):
-      d = {}
-      d[0] = "Unclassified"
-      d[11] = "Open Water"
-      d[21] = "Developed, Open Space"
-      d[22] = "Developed, Low Intensity"
-      d[23] = "Developed, Medium Intensity"
-      d[24] = "Developed, High Intensity"
-      d[31] = "Barren, Natural"
-      d[32] = "Barren, Anthropogenic"
-      d[41] = "Deciduous Forest"
-      d[42] = "Evergreen Forest"
-      d[43] = "Mixed Forest"
-      # d[45] = "Deciduous Forest - Silviculture"
-      # d[46] = "Evergreen Forest - Silviculture"
-      # d[47] = "Mixed Forest - Silviculture"
-      d[52] = "Shrub/Scrub"
-      d[56] = "Shrub/Scrub successional"
-      d[71] = "Herbaceous"
-      d[75] = "Harvested/Disturbed"
-      d[81] = "Hay/Pasture"
-      d[82] = "Cultivated Crops"
-      d[90] = "Woody Wetlands"
-      d[95] = "Emergent Herbaceous Wetlands"
-      
-      return d[val]
-      '''
-   else:
-      codeblock = '''def covClass(val):
-      d = {}
-      d[0] = "Undefined"
-      d[1] = "Open Water"
-      d[2] = "Developed"
-      d[3] = "Agriculture"
-      d[4] = "Natural"
-      d[5] = "Successional"
-      d[6] = "Harvested/Disturbed"  # This is Herbaceous which is in the Forest Change class in the change product
-      
-      return d[val]
-      '''
-   expression = "covClass(!Value!)"
-   
-   arcpy.AddField_management(inTab, "CoverClass", "TEXT", "", "", 50)
-   arcpy.CalculateField_management(inTab, "CoverClass", expression, "PYTHON", codeblock)
+   d = NLCD_COVER if schema == "NLCD" else GEN_COVER
+   if "CoverClass" not in [f.name for f in arcpy.ListFields(inTab)]:
+      arcpy.AddField_management(inTab, "CoverClass", "TEXT", "", "", 50)
+   with arcpy.da.UpdateCursor(inTab, ["Value", "CoverClass"]) as curs:
+      for row in curs:
+         curs.updateRow((row[0], d.get(row[0], "")))
    
    return inTab
     
-def tabLcTypes(rasterList, sumTab, clipShp = None):
+def _needsClip(rast, clipShp):
+   '''Checks whether a raster needs to be clipped to a feature class (see tabLcTypes). It does not if it already has the extent of the features (within a cell), and NoData in its corner cells (i.e., it is masked outside the features).
+   
+   Parameters:
+   - rast: the raster to check
+   - clipShp: the clipping feature class
+   '''
+   d = arcpy.Describe(rast)
+   r = d.extent
+   e = arcpy.Describe(clipShp).extent
+   cw, ch = d.meanCellWidth, d.meanCellHeight
+   if max(abs(r.XMin - e.XMin), abs(r.YMin - e.YMin), abs(r.XMax - e.XMax), abs(r.YMax - e.YMax)) >= cw:
+      return True
+   for x, y in [(r.XMin, r.YMin), (r.XMin, r.YMax - ch), (r.XMax - cw, r.YMin), (r.XMax - cw, r.YMax - ch)]:
+      if arcpy.RasterToNumPyArray(rast, arcpy.Point(x, y), 1, 1, nodata_to_value=0)[0, 0] != 0:
+         return True
+   return False
+
+def tabLcTypes(rasterList, sumTab, clipShp = None, clipMask = None):
    '''Tabulates the amount and percent cover for each land cover type, for each input raster. Calculates the amount of change between the first year and the last year in the sequence. Optionally, clips the rasters prior to tabulation. Modifies the rasters' attributes tables.
    
    Assumptions:
@@ -82,141 +184,134 @@ def tabLcTypes(rasterList, sumTab, clipShp = None):
    - rasterList: a list of rasters to be processed. 
    - sumTab: output summary table   
    - clipShp: an optional feature class used to clip each raster prior to calculating stats.
+   - clipMask: optional raster of clipShp from _rasterizeMask, on the grid of the input rasters. If not given, clipShp is rasterized once (if any raster needs clipping) and used for all rasters.
    '''
    
    c = 0 # initialize counter
-   y = [] # initialize list of years
+   tabs = {} # initialize attribute arrays, by year
+   tmpMask = None
    for rast in rasterList:
       name = os.path.basename(rast)
       printMsg('Working on %s'%rast)
       
       if clipShp:
          # Clip raster to clipShp, if applicable
-         rect = getRect(clipShp)
          clipRast = rast + '_clp'
-         if not arcpy.Exists(clipRast):
+         if not arcpy.Exists(clipRast) and not _needsClip(rast, clipShp):
+            printMsg('Already clipped.')
+            clipRast = rast
+         elif not arcpy.Exists(clipRast):
             printMsg('Clipping...')
-            # headsup: if workspace is set to memory/in_memory, the mask will not work correctly (at least in Pro 3.1.2)
-            arcpy.sa.ExtractByMask(rast, clipShp, "INSIDE", clipShp).save(clipRast)
-            # arcpy.Clip_management(rast, rect, clipRast, clipShp, "", "ClippingGeometry")
-            # Raster attribute table should be re-created, otherwise Count may not be up-to-date
-            arcpy.BuildRasterAttributeTable_management(clipRast, overwrite="OVERWRITE")
+            if not clipMask:
+               # Rasterize the features once, for all rasters
+               # headsup: if workspace is set to memory/in_memory, the mask will not work correctly (at least in Pro 3.1.2)
+               clipMask = tmpMask = _rasterizeMask(clipShp, rast, arcpy.env.scratchGDB + os.sep + "tmp_clipMask")
+            # Cells outside the mask are set to NoData; the raster attribute table is re-created by _blockedApply, so
+            # Count is up-to-date
+            _blockedApply([rast, clipMask], [clipRast], lambda a, win: [np.where(a[1] != 0, a[0], 0).astype(a[0].dtype, copy=False)])
       else:
          clipRast = rast
       
+      arr = arcpy.da.TableToNumPyArray(clipRast, ["Value", "Count"], skip_nulls=True)
       if c == 0:
          # get total pixel count; only need to do this once
          printMsg('Counting pixels...')
-         arr = arcpy.da.TableToNumPyArray(clipRast,["Value", "Count"], skip_nulls=True)
-         sum = arr["Count"].sum()
+         sum = int(arr["Count"].sum(dtype=np.int64))
       
       # determine year
       name = os.path.basename(clipRast)
       year = name[3:7]
       
-      # add and calculate percent field
-      printMsg('Creating and calculating percent field...')
+      # calculate percent, hectares, and acres fields in one pass, and add them to the attribute table
+      printMsg('Calculating percent, hectares, and acres fields...')
       percFld = "Percent_%s"%year
-      arcpy.AddField_management(clipRast, percFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, percFld, "100*!Count!/%s"%sum, "PYTHON")
-      
-      # add and calculate hectares field
-      printMsg('Creating and calculating hectares field...')
       haFld = "Area_ha_%s"%year
-      arcpy.AddField_management(clipRast, haFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, haFld, "!Count!*0.09", "PYTHON")
-      
-      # add and calculate acres field
-      printMsg('Creating and calculating acres field...')
       acFld = "Area_ac_%s"%year
-      arcpy.AddField_management(clipRast, acFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, acFld, "!Count!*0.2223948429", "PYTHON")
-      
-      # make or append to summary table: year, percent, hectares, acres
-      path = os.path.dirname(sumTab)
-      name = os.path.basename(sumTab)
-
-      if c == 0:
-         printMsg('Creating summary table...')
-         arcpy.TableToTable_conversion(clipRast, path, name) 
-         arcpy.DeleteField_management(sumTab, "Count;Red;Green;Blue;Opacity")
-         
-      else:
-         printMsg('Appending to summary table...')
-         arcpy.JoinField_management (sumTab, "Value", clipRast, "Value", [percFld, haFld, acFld])
-      
-      y.append(year) 
-      y.sort()
+      count = arr["Count"].astype(np.float64)
+      out = np.empty(len(arr), dtype=[("Value", "<i4"), (percFld, "<f4"), (haFld, "<f4"), (acFld, "<f4")])
+      out["Value"] = arr["Value"]
+      out[percFld] = count*(100.0/sum)
+      out[haFld] = count*0.09
+      out[acFld] = count*0.2223948429
+      arcpy.da.ExtendTable(clipRast, "Value", out, "Value", append_only=False)
+      tabs[year] = out
       c += 1 # update counter
    
    # determine start and end years and corresponding fields
-   c -= 1
+   y = sorted(tabs)
    startYear = y[0]
-   endYear = y[c]
-   
-   # Calculate change in hectares from start to end
+   endYear = y[-1]
    startHa = "Area_ha_%s"%startYear
    endHa = "Area_ha_%s"%endYear
-   printMsg('Creating and calculating hectares change field...')
-   arcpy.AddField_management(sumTab, "Change_ha", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_ha", "!%s! - !%s!"%(endHa,startHa), "PYTHON")
-   
-   # Calculate change in acres from start to end
    startAc = "Area_ac_%s"%startYear
    endAc = "Area_ac_%s"%endYear
-   printMsg('Creating and calculating acres change field...')
-   arcpy.AddField_management(sumTab, "Change_ac", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_ac", "!%s! - !%s!"%(endAc,startAc), "PYTHON")
-   
-   # Calculate percent change from start to end
-   printMsg('Creating and calculating change field...')
-   arcpy.AddField_management(sumTab, "Change_perc", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_perc", "100*(!%s! - !%s!)/!%s!"%(endHa,startHa,startHa), "PYTHON")
+   
+   # make summary table: percent, hectares, and acres for each year, for all values in any year
+   printMsg('Creating summary table...')
+   # one outer join of the yearly tables on Value; types missing in a year have no area
+   sumDf = reduce(lambda l, r: l.merge(r, on="Value", how="outer"), [pd.DataFrame(t) for t in tabs.values()])
+   sumDf = sumDf.fillna(0).sort_values("Value")
+   
+   # Calculate change in hectares, acres, and percent from start to end
+   printMsg('Calculating change fields...')
+   # Computed in float64 and stored as float32, like the yearly fields
+   ha0, ha1 = sumDf[startHa].astype(np.float64), sumDf[endHa].astype(np.float64)
+   sumDf["Change_ha"] = ha1 - ha0
+   sumDf["Change_ac"] = sumDf[endAc].astype(np.float64) - sumDf[startAc].astype(np.float64)
+   # percent change is undefined (NaN) for types not present in the start year
+   sumDf["Change_perc"] = 100*sumDf["Change_ha"]/ha0.where(ha0 != 0)
+   sumDf = sumDf.astype({f: np.float32 for f in sumDf.columns if f != "Value"}).astype({"Value": np.int32})
+   sumArr = sumDf.to_records(index=False)
+   
+   if arcpy.Exists(sumTab):
+      arcpy.Delete_management(sumTab)
+   arcpy.da.NumPyArrayToTable(sumArr, sumTab)
+   if tmpMask:
+      arcpy.Delete_management(tmpMask)
      
    printMsg('Finished.')
    return sumTab
 
-def reclassBarren(refRast, schema, inRast, outRast, cmap = None): 
-   '''For NLCD data: reclassifies the 31 (Barren) land cover class to 31 (for "natural barrens") or 32 (for "anthropogenic barrens"), based on a reference raster from a prior year.
+@lru_cache(maxsize=REF_CACHE_SIZE)
+def _refBarren(refRast, schema, cellSize, win):
+   '''Makes the class that barren (31) cells get from a reference raster (see reclassBarren), for a window, with NoData as 0. This only depends on the reference raster, so results for the last REF_CACHE_SIZE windows are cached by raster and window (main clears the cache at its start and end, since the key is the path). Neighborhood operations reach up to BARREN_HALO cells, or 100m if that is farther. The returned array is read-only.
    Parameters:
-   - refRast: input reference raster from a previous year
+   - refRast: reference raster from a previous year (must not change during the session)
    - schema: classification schema of refRast (1992 or standard)
-   - inRast: the raster for which the barren class should be reclassified
-   - out Rast: the updated raster with the barren class split into two types
+   - cellSize: cell size (meters)
+   - win: window to read, as (x and y of the lower left corner, number of columns, number of rows)
    '''
    # Reclassify reference raster to likeliest transition, only applicable IF the current raster is classed as barren. 
    # Rationale: If it was forest and is now barren, it is probably due to clearing, e.g. for mining (anthropogenic). If it was agriculture and is now barren, it may be due to clearing for development (anthropogenic). If it was water or wetland and is now barren, it is probably simply due to the shifting mosaic of barrier island habitats, and is now sand (natural). Etc. 
    # None of this matters if the current raster is anything other than 31.
 
-   refRast_rcls = 'ref_rcls'
-   if schema == '1992':
-      rclsTab = "0 NODATA;11 31;21 32;22 32;23 32;31 31;32 32;33 32;41 32;42 32;43 32;51 32;61 32;71 32;81 32;82 32;83 32;84 32;85 32;91 31;92 31"
-   else:
-      rclsTab = "0 NODATA;11 31;21 32;22 32;23 32;24 32; 31 31;32 32;41 32;42 32;43 32;52 32;71 32;81 32;82 32;90 31;95 31"
+   # All steps are done on arrays in memory, so no intermediate rasters are written.
+   refArr = arcpy.RasterToNumPyArray(refRast, arcpy.Point(win[0], win[1]), win[2], win[3], nodata_to_value=0)
    printMsg('Reclassifying reference raster...')
-   arcpy.gp.Reclassify_sa(refRast, "Value", rclsTab, refRast_rcls, "DATA")
+   lut = REF_RCLS_LUT["1992" if schema == "1992" else "standard"]
+   refRcls = lut[refArr]
    
    # Apply a majority filter to the reclassified reference raster
    # This is to get rid of the effect of errant speckles
-   refRast_filt = 'ref_filt'
    printMsg('Applying majority filter...')
-   arcpy.gp.FocalStatistics_sa(refRast_rcls, refRast_filt, "Rectangle 3 3 CELL", "MAJORITY", "DATA")
+   refFilt = _majority3x3(refRcls)
+   del refRcls
    
    # Expand the 31 class in the reclassified, filtered reference raster
    # This is to give the "natural" barren class additional leverage near shorelines
-   exp31 = 'ref_exp31'
    printMsg('Expanding 31 class...')
-   arcpy.gp.Expand_sa(refRast_filt, exp31, "3", "31")
+   exp31 = refFilt
+   exp31[ndimage.binary_dilation(refFilt == 31, structure=np.ones((3, 3), dtype=bool), iterations=3) & (refFilt != 0)] = 31
    
    # Get Euclidean distance to the 32 class in reference raster
    # If it's close to anthropogenic clearing, new barren land is more likely to be anthropogenic.
-   refRast_32 = 'ref_32'
-   printMsg('Creating raster for 32 class...')
-   arcpy.gp.SetNull_sa(refRast, "32", refRast_32, "Value <> 32")
-   
-   eDist32 = 'ref_eDist32'
+   # Only whether the distance is less than 100 meters is needed, so distances (in cells) are compared to 100 meters in
+   # cells and only the boolean result is kept.
    printMsg('Getting Euclidean distance to 32 class...')
-   arcpy.gp.EucDistance_sa(refRast_32, eDist32, "", "30", "")
+   if (refArr == 32).any():
+      close32 = ndimage.distance_transform_edt(refArr != 32) < 100.0 / cellSize
+   else:
+      close32 = np.zeros(refArr.shape, dtype=bool)
    
    # Apply series of if/then statements to get final classification
    # In English pseudocode:
@@ -227,16 +322,40 @@ def reclassBarren(refRast, schema, inRast, outRast, cmap = None):
    #     Else if the distance to a reference pixel coded 32 is less than 100 meters: recode to 32
    #     Else: recode to the most likely transition, determined from the "exp31" raster
    printMsg('Applying final raster calculation...')
-   inRast = Raster(inRast)
-   refRast = Raster(refRast)
-   eDist32 = Raster(eDist32)
-   exp31 = Raster(exp31)
-   
-   expression = """Con("%s" == 31,Con("%s" == 31,31,Con("%s" == 32,32,Con("%s" < 100,32,"%s"))),"%s")"""%(inRast, refRast, refRast, eDist32, exp31, inRast)
-   arcpy.gp.RasterCalculator_sa(expression, outRast)
-   
-   # Add cover class field
-   addCoverClass(outRast, schema="NLCD")
+   # The barren outcome is built up in place in exp31 with masked writes (later writes take precedence), then blended
+   # with the current raster in one np.where (_barrenArray).
+   barren = exp31
+   barren[close32 | (refArr == 32)] = 32
+   barren[refArr == 31] = 31
+   # NoData in the reference raster is NoData in the output, for barren pixels
+   barren[refArr == 0] = 0
+   del close32, refArr
+   barren.flags.writeable = False
+   return barren
+
+def _barrenArray(inArr, barren):
+   '''Makes the array for reclassBarren: barren (31) cells get their class from _refBarren, other cells keep their class.
+   Parameters:
+   - inArr: array of the raster for which the barren class should be reclassified
+   - barren: array from _refBarren, aligned with inArr
+   '''
+   return np.where(inArr == 31, barren, inArr).astype(inArr.dtype, copy=False)
+
+# Margin (cells) for block processing of _refBarren: majority filter (1) + expand (3). The 100m distance needs
+# 100 / cell size cells, which is less for 30m cells.
+BARREN_HALO = 4
+
+def _finishRast(outRast, schema, cmap = None, build_pyramids = True):
+   '''Adds cover class names, an optional color map, and pyramids to a reclassified raster.
+   Parameters:
+   - outRast: the reclassified raster
+   - schema: NLCD or Gen (general) codes (see addCoverClass)
+   - cmap: A colormap to apply to the raster (optional)
+   - build_pyramids: Whether to build pyramids. Set to False to build them later, e.g. for several rasters at once (see buildPyramids).
+   '''
+   # Add/populate land cover type field
+   printMsg('Adding cover class names...')
+   addCoverClass(outRast, schema)
    
    # Add color map
    if cmap:
@@ -244,13 +363,68 @@ def reclassBarren(refRast, schema, inRast, outRast, cmap = None):
       arcpy.AddColormap_management(outRast, "", cmap)
    
    # Build pyramids
-   printMsg('Building pyramids...')
-   arcpy.BuildPyramids_management(outRast)
+   if build_pyramids:
+      printMsg('Building pyramids...')
+      arcpy.BuildPyramids_management(outRast)
+   return outRast
+
+def buildPyramids(rasts, workers = 4):
+   '''Builds pyramids for a list of rasters, several at a time in threads. Most of the work is done outside Python, so threads run in parallel.
+   Parameters:
+   - rasts: list of rasters
+   - workers: number of threads
+   '''
+   with ThreadPoolExecutor(max_workers=workers) as ex:
+      for r in ex.map(arcpy.BuildPyramids_management, rasts):
+         printMsg('Built pyramids for %s'%r)
+   return rasts
+
+def reclassBarren(refRast, schema, inRast, outRast, cmap = None, build_pyramids = True, cache_ref = True): 
+   '''For NLCD data: reclassifies the 31 (Barren) land cover class to 31 (for "natural barrens") or 32 (for "anthropogenic barrens"), based on a reference raster from a prior year.
+   Parameters:
+   - refRast: input reference raster from a previous year
+   - schema: classification schema of refRast (1992 or standard)
+   - inRast: the raster for which the barren class should be reclassified
+   - out Rast: the updated raster with the barren class split into two types
+   - cmap: A colormap to apply to the output raster (optional)
+   - build_pyramids: Whether to build pyramids for the output raster
+   - cache_ref: Whether to cache the reference products (see _refBarren). Set to False when refRast is used once.
+   '''
+   cellSize = arcpy.Describe(inRast).meanCellWidth
+   halo = max(BARREN_HALO, int(np.ceil(100.0 / cellSize)))
+   ref = _refBarren if cache_ref else _refBarren.__wrapped__
+   _blockedApply([inRast], [outRast], lambda a, win: [_barrenArray(a[0], ref(refRast, schema, cellSize, win))], halo)
+   _finishRast(outRast, "NLCD", cmap, build_pyramids)
 
    printMsg('Finished.')
    return outRast
+
+def reclassBarrenAndGeneral(refRast, schema, inRast, outBarren, outGeneral, cmap = None, build_pyramids = True, cache_ref = True):
+   '''Runs reclassBarren, and reclassGeneral on its output, in one pass. The general land cover is reclassified from the barren array in memory, rather than from the written raster.
+   Parameters:
+   - refRast: input reference raster from a previous year
+   - schema: classification schema of refRast (1992 or standard)
+   - inRast: the raster for which the barren class should be reclassified
+   - outBarren: the updated raster with the barren class split into two types
+   - outGeneral: the general land cover raster (see reclassGeneral)
+   - cmap: A colormap to apply to outBarren (optional)
+   - build_pyramids: Whether to build pyramids for the output rasters
+   - cache_ref: Whether to cache the reference products (see _refBarren). Set to False when refRast is used once.
+   '''
+   cellSize = arcpy.Describe(inRast).meanCellWidth
+   halo = max(BARREN_HALO, int(np.ceil(100.0 / cellSize)))
+   ref = _refBarren if cache_ref else _refBarren.__wrapped__
+   def fn(a, win):
+      out = _barrenArray(a[0], ref(refRast, schema, cellSize, win))
+      return [out, GEN_LUT[out]]
+   _blockedApply([inRast], [outBarren, outGeneral], fn, halo)
+   _finishRast(outBarren, "NLCD", cmap, build_pyramids)
+   _finishRast(outGeneral, "Gen", None, build_pyramids)
+   
+   printMsg('Finished.')
+   return outBarren, outGeneral
    
-def reclassGeneral(inRast, outRast, cmap = None):
+def reclassGeneral(inRast, outRast, cmap = None, build_pyramids = True):
    '''Reclassifies NLCD data to more general land cover types. 
    
    Assumption: Barren Land class (NLCD code 31) has already been split into Barren, Anthropogenic (32) and Barren, Natural (31)
@@ -259,6 +433,7 @@ def reclassGeneral(inRast, outRast, cmap = None):
    - inRast: Input raster to be reclassified
    - outRast: Output raster that has been reclassified
    - cmap: A colormap to apply to the output raster (optional)
+   - build_pyramids: Whether to build pyramids for the output raster
    
    Reclassification schema:
    - 1 (Open Water) includes NLCD code 11 only
@@ -270,29 +445,43 @@ def reclassGeneral(inRast, outRast, cmap = None):
    - 6 (Harvested/Disturbed) includes derived code 75 (NLCD herbaceous which is in the "Forest change" class in the NLCD change raster [currently for 2001-2019]).
    - 7 (maintained grass/Shrubland)
    '''
-   # Reclassify data
-   # rclsTab = "0 NODATA;11 1;21 2;22 2;23 2;24 2; 31 4;32 2;41 4;42 4;43 4;52 5;71 5;81 3;82 3;90 4;95 4"
-   rclsTab = "0 NODATA;11 1;21 2;22 2;23 2;24 2;31 4;32 2;41 4;42 4;43 4;52 5;56 5;71 5;75 6;81 3;82 3;90 4;95 4"  # includes forest-change added classes
+   # Reclassify data, with a lookup table (GEN_LUT). This includes the forest-change added classes (56, 75).
    printMsg('Reclassifying raster...')
-   arcpy.gp.Reclassify_sa(inRast, "Value", rclsTab, outRast, "DATA")
-   
-   # Add/populate land cover type field
-   printMsg('Adding cover class names...')
-   addCoverClass(outRast, "Gen")
-   
-   # Add color map
-   if cmap:
-      printMsg('Adding color map...')
-      arcpy.AddColormap_management(outRast, "", cmap)
-   
-   # Build pyramids
-   printMsg('Building pyramids...')
-   arcpy.BuildPyramids_management(outRast)
+   _blockedApply([inRast], [outRast], lambda a, win: [GEN_LUT[a[0]]])
+   _finishRast(outRast, "Gen", cmap, build_pyramids)
 
    printMsg('Finished.')
    return outRast
    
-def reclassForestChange(inLC, inChangeProd, outRast, clipShp = None):
+def reclassGeneralProc(inRast, outRast, out_gdb, cmap = None, build_pyramids = True):
+   '''Runs reclassGeneral in a worker process (see main). Environment settings are not shared between processes, so they are set here, with a scratch geodatabase for the process.
+   
+   Parameters:
+   - inRast: Input raster to be reclassified
+   - outRast: Output raster that has been reclassified
+   - out_gdb: Output geodatabase; the scratch geodatabase is made alongside it, named with the process id
+   - cmap: A colormap to apply to the output raster (optional)
+   - build_pyramids: Whether to build pyramids for the output raster
+   '''
+   scratch_gdb = out_gdb.replace(".gdb", "_w" + str(os.getpid()) + ".gdb")
+   make_gdb(scratch_gdb)
+   arcpy.env.workspace = scratch_gdb
+   arcpy.env.overwriteOutput = True
+   return reclassGeneral(inRast, outRast, cmap, build_pyramids)
+   
+def _rasterizeMask(clipShp, template, outRast):
+   '''Rasterizes a feature class on the grid of a template raster, with feature cells as their (non-zero) object ID, and NoData elsewhere.
+   
+   Parameters:
+   - clipShp: the feature class
+   - template: raster providing the extent, cell size, and alignment
+   - outRast: output raster
+   '''
+   with arcpy.EnvManager(extent=template, snapRaster=template, cellSize=template, outputCoordinateSystem=template):
+      arcpy.conversion.PolygonToRaster(clipShp, arcpy.Describe(clipShp).OIDFieldName, outRast, "CELL_CENTER", "", template)
+   return outRast
+
+def reclassForestChange(inLC, inChangeProd, outRast, clipShp = None, clipMask = None, build_pyramids = True):
    """
    headsup: experimental: use change product from NLCD to identify likely silvicultural areas.
    
@@ -304,20 +493,38 @@ def reclassForestChange(inLC, inChangeProd, outRast, clipShp = None):
    conflict with any original NLCD class values.
    
    This re-classifies shrub/scrub or herbaceous, if it falls in the "forest change" (11) class of the NLCD change product raster.
+   The change product must be aligned with inLC (same cell size and snapping). The output has the extent of inLC; with 
+   clipShp, cells outside the features are NoData.
       
    :param inLandCover: input classified land cover
    :param inChangeProd: NLCD change product raster
    :param outRast: output classified land cover with silviculture class(es)
+   :param clipShp: optional feature class to mask the output
+   :param clipMask: optional raster of clipShp from _rasterizeMask, on the grid of inLC (used instead of rasterizing clipShp)
+   :param build_pyramids: Whether to build pyramids for the output raster
    :return: outRast
    """
    # working
    print("Using change product to add forest change class using " + inLC + "...")
-   # expression = """Con(("%s" == 41) | ("%s" == 42) | ("%s" == 43) | ("%s" == 52) | ("%s" == 71), Con("%s" == 11, "%s" + 4, "%s"), "%s")""" % (inLC, inLC, inLC, inLC, inLC, inChangeProd, inLC, inLC, inLC)
-   expression = """Con(("%s" == 52) | ("%s" == 71), Con("%s" == 11, "%s" + 4, "%s"), "%s")""" % (inLC, inLC, inChangeProd, inLC, inLC, inLC)
-   with arcpy.EnvManager(extent=clipShp, mask=clipShp, cellSize=inLC, snapRaster=inLC):
-      arcpy.gp.RasterCalculator_sa(expression, outRast)
-   arcpy.BuildPyramids_management(outRast)
-   arcpy.BuildRasterAttributeTable_management(outRast)
+   # Done on arrays, equivalent to:
+   # Con(("inLC" == 52) | ("inLC" == 71), Con("inChangeProd" == 11, "inLC" + 4, "inLC"), "inLC")
+   def fn(a, win):
+      lc = a[0]
+      out = np.where(((lc == 52) | (lc == 71)) & (a[1] == 11), lc + 4, lc).astype(np.uint8, copy=False)
+      if len(a) > 2:
+         out[a[2] == 0] = 0
+      return [out]
+   rasts = [inLC, inChangeProd]
+   tmpMask = None
+   if clipShp and not clipMask:
+      clipMask = tmpMask = _rasterizeMask(clipShp, inLC, arcpy.env.scratchGDB + os.sep + "tmp_clipMask")
+   if clipMask:
+      rasts.append(clipMask)
+   _blockedApply(rasts, [outRast], fn)
+   if tmpMask:
+      arcpy.Delete_management(tmpMask)
+   if build_pyramids:
+      arcpy.BuildPyramids_management(outRast)
    addCoverClass(outRast, "NLCD")
    print("Done with " + outRast + ".")
    return outRast
@@ -358,9 +565,22 @@ def main():
    # if not arcpy.Exists(change_prod):
    #    arcpy.sa.ExtractByMask(change_prod_orig, mask).save(change_prod)
    
+   # Rasterized clipShp, shared by the forest change reclassification and summaries
+   clipMask = out_gdb + os.sep + "clipMask"
+   if not arcpy.Exists(clipMask):
+      _rasterizeMask(clipShp, nlcd_rasts[0][1], clipMask)
+   
+   # Whether each year uses the prior year's output as the reference raster for barrens (True), or all years use
+   # nlcd_1992 (False). With a fixed reference, the reference products are made once (see _refBarren); chained
+   # references are each used once, so they are not cached.
+   chainRef = True
+   # cached reference products are keyed by path, so none are kept from a previous run in the session
+   _refBarren.cache_clear()
+   
+   newRasts = [] # rasters made in this run; pyramids are built for them at the end
    # Loop over nlcd 2001-2019
    for n in enumerate(nlcd_rasts):
-      if n[0] == 0:
+      if n[0] == 0 or not chainRef:
          ref = nlcd_1992
          refYear = "1992"
       else:
@@ -368,36 +588,60 @@ def main():
          refYear = "2001"
       inRast = n[1]
       outRast = out_gdb + os.sep + 'lc_' + str(inRast[0]) + '_rclsBarrens'
-      if not arcpy.Exists(outRast):
+      outRast_gen = out_gdb + os.sep + 'lc_' + str(inRast[0]) + '_rclsGeneral'
+      if not arcpy.Exists(outRast) and not arcpy.Exists(outRast_gen):
+         # Makes general land cover in the same pass
+         print("Making " + outRast + " and " + outRast_gen + "...")
+         reclassBarrenAndGeneral(ref, refYear, inRast[1], outRast, outRast_gen, cmap, build_pyramids=False, cache_ref=not chainRef)
+         newRasts += [outRast, outRast_gen]
+      elif not arcpy.Exists(outRast):
          print("Making " + outRast + "...")
-         reclassBarren(ref, refYear, inRast[1], outRast, cmap)
+         reclassBarren(ref, refYear, inRast[1], outRast, cmap, build_pyramids=False, cache_ref=not chainRef)
+         newRasts.append(outRast)
       else:
          print("Already exists: " + outRast + "...")
-      # Makes general land cover
-      outRast_gen = out_gdb + os.sep + 'lc_' + str(inRast[0]) + '_rclsGeneral'
-      if not arcpy.Exists(outRast_gen):
-         reclassGeneral(outRast, outRast_gen)
       
       # coulddo: run again to add Silviculture class (current forest which has/will experience change).
       # With silviculture classes
       # outRast_For = out_gdb + os.sep + 'lc_' + str(inRast[0]) + '_rclsFor'
       # if not arcpy.Exists(outRast_For):
-      #    reclassForestChange(outRast, change_prod, outRast_For, clipShp=clipShp)
+      #    reclassForestChange(outRast, change_prod, outRast_For, clipShp=clipShp, clipMask=clipMask)
       # # Makes general land cover
       # outRast_genFor = out_gdb + os.sep + 'lc_' + str(inRast[0]) + '_rclsGeneralFor'
       # if not arcpy.Exists(outRast_genFor):
       #    reclassGeneral(outRast_For, outRast_genFor)
       
+   # Makes general land cover, where not made with the barren rasters. Each year is independent (unlike the barren
+   # reclassification, which uses the prior year as reference), so years are processed in parallel.
+   gen = [[out_gdb + os.sep + 'lc_' + str(n[0]) + '_rclsBarrens', out_gdb + os.sep + 'lc_' + str(n[0]) + '_rclsGeneral'] for n in nlcd_rasts]
+   gen = [g for g in gen if not arcpy.Exists(g[1])]
+   if gen:
+      workers = min(len(gen), max(1, os.cpu_count() // 2))
+      with ProcessPoolExecutor(max_workers=workers) as ex:
+         for outRast_gen in ex.map(partial(reclassGeneralProc, out_gdb=out_gdb, build_pyramids=False), [g[0] for g in gen], [g[1] for g in gen]):
+            print("Finished " + outRast_gen + ".")
+            newRasts.append(outRast_gen)
+      # Remove the scratch geodatabases of the worker processes
+      for g in glob.glob(out_gdb.replace(".gdb", "_w*.gdb")):
+         arcpy.Delete_management(g)
+   
+   # release the cached reference products (the module is kept loaded between runs, e.g. in IDLE)
+   _refBarren.cache_clear()
+   
+   # Pyramids for all new rasters, built at the end and in parallel
+   if newRasts:
+      buildPyramids(newRasts)
+   
    ### Summarizing all land cover
    # rasterList = [out_gdb + os.sep + 'lc_' + str(n[0]) + '_rclsBarrens' for n in nlcd_rasts]
    # sumTab = out_gdb + os.sep + 'lc_rclsBarren_changeSummary'
    # clipShp = r'D:\projects\GIS_Data\Reference_Data.gdb\VirginiaCounty_dissolved'
-   # tabLcTypes(rasterList, sumTab, clipShp)
+   # tabLcTypes(rasterList, sumTab, clipShp, clipMask)
    
    ### Summarizing general land cover
    rasterList = [out_gdb + os.sep + 'lc_' + str(n[0]) + '_rclsGeneral' for n in nlcd_rasts]
    sumTab = out_gdb + os.sep + 'lc_rclsGeneral_changeSummary_upd2021_chk'
-   tabLcTypes(rasterList, sumTab, clipShp)
+   tabLcTypes(rasterList, sumTab, clipShp, clipMask)
    addCoverClass(sumTab, "Gen")
    
    ### Summarizing general land cover (w/ harvested/disturbed)
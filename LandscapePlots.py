@@ -8,52 +8,25 @@
 # Usage notes: This is written to run under the Python environment shipped with ArcGIS Pro. Start by running the executable proenv.bat, then type "idle" in the command window to get the IDLE window running the correct version of Python.
 # ---------------------------------------------------------------------------
 
-import arcpy
-import matplotlib.pyplot as plt
-from matplotlib.gridspec import GridSpec
-from matplotlib.ticker import (MultipleLocator, AutoMinorLocator)
+# arcpy, matplotlib, and PIL are imported in the functions that use them, since importing arcpy and pyplot takes
+# several seconds and this module may be imported by scripts that don't plot
 import numpy
+from LandCoverCodes import GEN_LUT, GEN_COVER
+
    
-def plotGeneralChange(yearList, sumTab, outFig):
-   '''Plots land cover area (hectares) over time, for generalized classes of NLCD landcover:
-      - Open Water
-      - Developed
-      - Agriculture
-      - Natural
-      - Successional
-      
-      Parameters:
-      -yearList: list of years to plot. Must be valid NLCD years.
-      -sumTab: summary table with the general categories and the hectare values for each year.
-      
-      Plot adapted from code here: http://lagrange.univ-lyon1.fr/docs/matplotlib/examples/pylab_examples/broken_axis.html
-   '''   
+def _prepareFig(yearList):
+   '''Makes the figure for plotGeneralChange, with all static styling applied: titles, axis labels, tick positions, and
+   a y axis broken into a top part (ax1) and a bottom part (ax2), with diagonal break lines. Returns the figure and the
+   two axes.
+   
+   Parameters:
+   -yearList: list of years to plot, used for the x ticks.
+   
+   Plot adapted from code here: http://lagrange.univ-lyon1.fr/docs/matplotlib/examples/pylab_examples/broken_axis.html
+   '''
+   import matplotlib.pyplot as plt
+   from matplotlib.gridspec import GridSpec
    
-   base = 'Area_ha'
-   flds = ['Value', 'CoverClass']
-   
-   for y in yearList:
-      fld = base + '_%s'%str(y)
-      flds.append(fld)
-   
-   arr = arcpy.da.TableToNumPyArray (sumTab, flds)
-   fldNames = ['Code','Class']
-   for y in yearList:
-      fldNames.append(str(y))
-   fldNames = tuple(fldNames)
-   arr.dtype.names = fldNames
-   
-   wat = list(arr[0])
-   wat.append('Blue')
-   dev = list(arr[1])
-   dev.append('DarkRed')
-   agr = list(arr[2])
-   agr.append('GoldenRod')
-   nat = list(arr[3])
-   nat.append('DarkGreen')
-   suc = list(arr[4])
-   suc.append('LimeGreen')
-
    fig = plt.figure(figsize=(6,6))
    fig.suptitle('Land Cover in Virginia')
    fig.text(0.04, 0.5, 'Millions of Hectares', va='center', rotation='vertical')
@@ -86,20 +59,7 @@ def plotGeneralChange(yearList, sumTab, outFig):
    # zoom-in / limit the view to different portions of the data
    ax1.set_ylim(6.3, 6.8)
    ax2.set_ylim(0.3, 2.3)
-   
-   lineobjects = []
-   for lc in [wat, dev, agr, nat, suc]:
-      yvals = lc[2:-1]
-      millions = [y/1000000 for y in yvals]
-      
-      # plot the same data on both axes
-      ax2.plot(yearList, millions, linestyle = '-', marker='o', label = lc[1], color = lc[-1])
-      ax1.plot(yearList, millions, linestyle = '-', marker='o', label = lc[1], color = lc[-1])
-      lineobjects.append(lc[1])
-   legend = fig.legend(lineobjects, loc = 'upper right', bbox_to_anchor=(0.5, 0.6), framealpha = 1)
    plt.subplots_adjust(left = 0.15, right=0.95, top = 0.93, hspace = 0)
-   #plt.xlabel('Year')
-
    
    # Make the plot breaklines
    d = .015  # how big to make the diagonal lines in axes coordinates
@@ -111,9 +71,110 @@ def plotGeneralChange(yearList, sumTab, outFig):
    kwargs.update(transform=ax2.transAxes)  # switch to the bottom axes
    ax2.plot((-d, +d), (1 - d, 1 + d), **kwargs)  # bottom-left diagonal
    ax2.plot((1 - d, 1 + d), (1 - d, 1 + d), **kwargs)  # bottom-right diagonal
+   return fig, ax1, ax2
+   
+def tabGeneralAreas(rasterList, yearList, schema = "Gen", block = None):
+   '''Tabulates land cover area (hectares) by general class for each year, as input for plotGeneralChange without an
+   intermediate summary table. Cells are counted with numpy.bincount over blocks of each raster, in one pass per
+   raster, so memory use is bounded by the block size.
+   
+   Parameters:
+   -rasterList: list of land cover rasters, one for each year in yearList.
+   -yearList: list of years, matching rasterList.
+   -schema: "Gen" for rasters with general land cover codes (as made by reclassGeneral), or "NLCD" for NLCD codes (with
+    barren split into 31 and 32). NLCD class counts are summed into general classes with GEN_LUT.
+   -block: block size, in cells (by default, BLOCK_SIZE from Helper).
+   
+   Returns a structured array with Value, CoverClass, and Area_ha_[year] fields, as in the summary table from tabLcTypes.
+   '''
+   import arcpy
+   from Helper import blockWindows, BLOCK_SIZE
+   block = block or BLOCK_SIZE
+   
+   areas = []
+   for rast in rasterList:
+      d = arcpy.Describe(rast)
+      cw, ch = d.meanCellWidth, d.meanCellHeight
+      counts = numpy.zeros(256, dtype=numpy.int64)
+      for i, j, h, w, ll, i0, j0, rll, rcols, rrows in blockWindows(d, block):
+         a = arcpy.RasterToNumPyArray(rast, ll, w, h, nodata_to_value=0)
+         counts += numpy.bincount(a.ravel(), minlength=256)[:256]
+      if schema == "NLCD":
+         # sum the class counts by general class (the lookup is applied to the histogram, not the cells)
+         counts = numpy.bincount(GEN_LUT, weights=counts, minlength=256)
+      counts[0] = 0
+      areas.append(counts * cw * ch / 10000)
+   
+   areas = numpy.array(areas)
+   vals = numpy.nonzero(areas.sum(axis=0))[0]
+   out = numpy.zeros(len(vals), dtype=[('Value', '<i4'), ('CoverClass', '<U50')] + [('Area_ha_%s'%str(y), '<f4') for y in yearList])
+   out['Value'] = vals
+   out['CoverClass'] = [GEN_COVER.get(v, "") for v in vals]
+   for y, a in zip(yearList, areas):
+      out['Area_ha_%s'%str(y)] = a[vals]
+   return out
+
+def plotGeneralChange(yearList, sumTab, outFig, interactive=True):
+   '''Plots land cover area (hectares) over time, for generalized classes of NLCD landcover:
+      - Open Water
+      - Developed
+      - Agriculture
+      - Natural
+      - Successional
+      
+      Parameters:
+      -yearList: list of years to plot. Must be valid NLCD years.
+      -sumTab: summary table with the general categories and the hectare values for each year, or an array with the
+       same fields (as returned by tabGeneralAreas).
+      -outFig: output figure file. PNG files are written directly from the rendered image.
+      -interactive: whether to show the plot. Set to False for batch runs; the figure is closed after saving.
+      
+      Plot adapted from code here: http://lagrange.univ-lyon1.fr/docs/matplotlib/examples/pylab_examples/broken_axis.html
+   '''   
+   import matplotlib.pyplot as plt
+   from matplotlib.collections import LineCollection
+   from matplotlib.lines import Line2D
+   from matplotlib.backends.backend_agg import FigureCanvasAgg
+   from numpy.lib import recfunctions as rfn
+   from PIL import Image
+   
+   base = 'Area_ha'
+   areaFlds = [base + '_%s'%str(y) for y in yearList]
+   if isinstance(sumTab, numpy.ndarray):
+      arr = sumTab
+   else:
+      import arcpy
+      arr = arcpy.da.TableToNumPyArray (sumTab, ['Value', 'CoverClass'] + areaFlds)
+   
+   # rows (in table order) are water, developed, agriculture, natural, and successional
+   colors = ['Blue', 'DarkRed', 'GoldenRod', 'DarkGreen', 'LimeGreen']
+   labels = arr['CoverClass'][:len(colors)]
+   # (classes x years) matrix of the area fields, as a view where they share a type
+   millions = rfn.structured_to_unstructured(arr[areaFlds][:len(colors)]) / 1000000
+
+   fig, ax1, ax2 = _prepareFig(yearList)
+   
+   # plot the same data on both axes: all classes as one line collection and one set of markers per axis
+   segs = numpy.dstack((numpy.broadcast_to(yearList, millions.shape), millions))
+   for ax in (ax1, ax2):
+      ax.add_collection(LineCollection(segs, colors=colors, linestyle='-', zorder=2))
+      ax.scatter(segs[:, :, 0].ravel(), segs[:, :, 1].ravel(), c=numpy.repeat(colors, len(yearList)), marker='o', s=36, zorder=3)
+      ax.autoscale_view()
+   handles = [Line2D([], [], linestyle='-', marker='o', color=c) for c in colors]
+   legend = fig.legend(handles, labels, loc = 'upper right', bbox_to_anchor=(0.5, 0.6), framealpha = 1)
    
-   plt.savefig(outFig)
-   plt.show()
+   if outFig.lower().endswith('.png'):
+      # render once, and encode the RGBA buffer (Agg-based canvases, including the interactive ones, have one)
+      canvas = fig.canvas if isinstance(fig.canvas, FigureCanvasAgg) else FigureCanvasAgg(fig)
+      canvas.draw()
+      # (zlib level 1: several times faster than the default level 6, for slightly larger files)
+      Image.fromarray(numpy.asarray(canvas.buffer_rgba())).save(outFig, compress_level=1, optimize=False)
+   else:
+      fig.savefig(outFig)
+   if interactive:
+      plt.show()
+   else:
+      plt.close(fig)
    return outFig
       
 # Use the main function below to run desired function(s) directly from Python IDE or command line with hard-coded variables
@@ -127,6 +188,10 @@ def main():
    
    # Specify function(s) to run below
    plotGeneralChange(yearList, sumTab, outFig)
+   # or, from the general land cover rasters directly (no summary table):
+   # gdb = r'C:\David\proc\NLCD_chg\nlcd_2019ed_LandCover_albers_rclsBarrens.gdb'
+   # rasterList = [gdb + '\\lc_' + str(y) + '_rclsGeneral' for y in yearList]
+   # plotGeneralChange(yearList, tabGeneralAreas(rasterList, yearList), outFig)
    
 if __name__ == '__main__':
    main()
\ No newline at end of file
@@ -31,6 +31,31 @@ def getRect(spatialObject):
    rect = "%s %s %s %s" %(ext.XMin, ext.YMin, ext.XMax, ext.YMax)
    return rect
 
+# Block size (cells) for reading rasters a block at a time (see blockWindows); uint8 blocks are 4 MB
+BLOCK_SIZE = 2048
+
+# Pixel types for MosaicToNewRaster, by array data type
+PIXEL_TYPES = {"uint8": "8_BIT_UNSIGNED", "int8": "8_BIT_SIGNED", "uint16": "16_BIT_UNSIGNED", "int16": "16_BIT_SIGNED", "uint32": "32_BIT_UNSIGNED", "int32": "32_BIT_SIGNED", "float32": "32_BIT_FLOAT"}
+
+def blockWindows(d, block = BLOCK_SIZE, halo = 0):
+   '''Generates the blocks of a raster, for reading it with RasterToNumPyArray a block at a time, so memory use is bounded. Each block's read window has a margin of halo cells (clipped to the raster), for neighborhood operations.
+   
+   Parameters:
+   - d: Describe object of the raster (or of a template raster, for reading other rasters in its window)
+   - block: block size, in cells
+   - halo: number of cells to add around each block
+   
+   Yields, for each block: its first row and column, height, width, and lower left corner; and the read window's first row and column, lower left corner, number of columns, and number of rows. Without a halo, the read window is the block.
+   '''
+   cw, ch, xmin, ymax = d.meanCellWidth, d.meanCellHeight, d.extent.XMin, d.extent.YMax
+   for i in range(0, d.height, block):
+      for j in range(0, d.width, block):
+         h, w = min(block, d.height - i), min(block, d.width - j)
+         i0, j0 = max(i - halo, 0), max(j - halo, 0)
+         i1, j1 = min(i + block + halo, d.height), min(j + block + halo, d.width)
+         yield (i, j, h, w, arcpy.Point(xmin + j*cw, ymax - (i + h)*ch),
+                i0, j0, arcpy.Point(xmin + j0*cw, ymax - i1*ch), j1 - j0, i1 - i0)
+
 def getScratchMsg(scratchGDB):
    '''Prints message informing user of where scratch output will be written'''
    if scratchGDB != "in_memory":
@@ -55,10 +80,11 @@ def printErr(msg):
 def garbagePickup(trashList):
    '''Deletes Arc files in list, with error handling. Argument must be a list.'''
    for t in trashList:
-      try:
-         arcpy.Delete_management(t)
-      except:
-         pass
+      if arcpy.Exists(t):
+         try:
+            arcpy.Delete_management(t)
+         except arcpy.ExecuteError:
+            pass
    return
    
 def CleanFeatures(inFeats, outFeats):
@@ -67,27 +93,21 @@ def CleanFeatures(inFeats, outFeats):
    # Process: Repair Geometry
    arcpy.RepairGeometry_management(inFeats, "DELETE_NULL")
 
-   # Have to add the while/try/except below b/c polygon explosion sometimes fails inexplicably.
-   # This gives it 10 tries to overcome the problem with repeated geometry repairs, then gives up.
-   counter = 1
-   while counter <= 10:
+   # Have to add the try/except below b/c polygon explosion sometimes fails inexplicably.
+   # On failure, this repairs geometry once more and tries again, then gives up and copies the features.
+   try:
+      # Process: Multipart To Singlepart
+      arcpy.MultipartToSinglepart_management(inFeats, outFeats)
+   except arcpy.ExecuteError:
+      arcpy.AddMessage("Polygon explosion failed.")
+      # Process: Repair Geometry
+      arcpy.AddMessage("Trying to repair geometry again...")
+      arcpy.RepairGeometry_management(inFeats, "DELETE_NULL")
       try:
-         # Process: Multipart To Singlepart
          arcpy.MultipartToSinglepart_management(inFeats, outFeats)
-         
-         counter = 11
-         
-      except:
-         arcpy.AddMessage("Polygon explosion failed.")
-         # Process: Repair Geometry
-         arcpy.AddMessage("Trying to repair geometry (try # %s)" %str(counter))
-         arcpy.RepairGeometry_management(inFeats, "DELETE_NULL")
-         
-         counter +=1
-         
-         if counter == 11:
-            arcpy.AddMessage("Polygon explosion problem could not be resolved.  Copying features.")
-            arcpy.CopyFeatures_management (inFeats, outFeats)
+      except arcpy.ExecuteError:
+         arcpy.AddMessage("Polygon explosion problem could not be resolved.  Copying features.")
+         arcpy.CopyFeatures_management (inFeats, outFeats)
    
    return outFeats
 
@@ -148,12 +168,8 @@ def unique_values(table, field):
    
 def TabToDict(inTab, fldKey, fldValue):
    '''Converts two fields in a table to a dictionary'''
-   codeDict = {}
    with arcpy.da.SearchCursor(inTab, [fldKey, fldValue]) as sc:
-      for row in sc:
-         key = sc[0]
-         val = sc[1]
-         codeDict[key] = val
+      codeDict = {row[0]: row[1] for row in sc}
    return codeDict 
    
 def GetElapsedTime (t1, t2):
@@ -201,8 +217,22 @@ def tback():
    
    return msgList
    
+# Data type and spatial reference, by dataset (see describeInfo)
+_describeCache = {}
+
+def describeInfo(dataset):
+   '''Gets the data type and spatial reference of a dataset, describing it only on the first call. Datasets are assumed not to be replaced (with a different type or coordinate system) during the session, so in_memory/memory datasets and layers (names without a path), which are often recreated, are described on every call.'''
+   ds = str(dataset)
+   if ds.lower().startswith(("in_memory", "memory")) or not ("\\" in ds or "/" in ds):
+      desc = arcpy.Describe(dataset)
+      return (desc.dataType, getattr(desc, "spatialReference", None))
+   if dataset not in _describeCache:
+      desc = arcpy.Describe(dataset)
+      _describeCache[dataset] = (desc.dataType, getattr(desc, "spatialReference", None))
+   return _describeCache[dataset]
+
 def clearSelection(fc):
-   typeFC= (arcpy.Describe(fc)).dataType
+   typeFC = arcpy.Describe(fc).dataType
    if typeFC == 'FeatureLayer':
       arcpy.SelectLayerByAttribute_management (fc, "CLEAR_SELECTION")
       
@@ -236,18 +266,17 @@ def Coalesce(inFeats, dilDist, outFeats, scratchGDB = "in_memory"):
    Buff1 = scratchGDB + os.sep + "Buff1"
    arcpy.Buffer_analysis(inFeats, Buff1, meas, "FULL", "ROUND", dissolve1, "", "PLANAR")
 
-   # Process: Clean Features
-   Clean_Buff1 = scratchGDB + os.sep + "CleanBuff1"
-   CleanFeatures(Buff1, Clean_Buff1)
+   # Buffer output has valid geometry, so it is not cleaned here; only the final output is (below).
+   # Multipart features from the dissolve are handled part by part by the tools below.
 
    # Process:  Generalize Features
    # This should prevent random processing failures on features with many vertices, and also speed processing in general
-   arcpy.Generalize_edit(Clean_Buff1, "0.1 Meters")
+   arcpy.Generalize_edit(Buff1, "0.1 Meters")
    
    # Eliminate gaps
    # Added step due to weird behavior on some buffers
    Clean_Buff1_ng = scratchGDB + os.sep + "Clean_Buff1_ng"
-   arcpy.EliminatePolygonPart_management (Clean_Buff1, Clean_Buff1_ng, "AREA", "900 SQUAREMETERS", "", "CONTAINED_ONLY")
+   arcpy.EliminatePolygonPart_management (Buff1, Clean_Buff1_ng, "AREA", "900 SQUAREMETERS", "", "CONTAINED_ONLY")
 
    # Process: Buffer
    Buff2 = scratchGDB + os.sep + "NegativeBuffer"
@@ -258,7 +287,7 @@ def Coalesce(inFeats, dilDist, outFeats, scratchGDB = "in_memory"):
       
    # Cleanup
    if scratchGDB == "in_memory":
-      garbagePickup([Buff1, Clean_Buff1, Buff2])
+      garbagePickup([Buff1, Clean_Buff1_ng, Buff2])
       
    return outFeats
    
@@ -280,10 +309,7 @@ def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti = 8, scratchGDB = "in_memor
    trashList = []
 
    # Declare path/name of output data and workspace
-   drive, path = os.path.splitdrive(outFeats) 
-   path, filename = os.path.split(path)
-   myWorkspace = drive + path
-   Output_fname = filename
+   myWorkspace, Output_fname = os.path.split(outFeats)
 
    # Process:  Create Feature Class (to store output)
    arcpy.CreateFeatureclass_management (myWorkspace, Output_fname, "POLYGON", "", "", "", inFeats) 
@@ -325,43 +351,60 @@ def ShrinkWrap(inFeats, dilDist, outFeats, smthMulti = 8, scratchGDB = "in_memor
    numWraps = (arcpy.GetCount_management(explFeats)).getOutput(0)
    arcpy.AddMessage('Shrinkwrapping: There are %s features after consolidation' %numWraps)
 
+   # Process:  Make Feature Layer (once, reused for each exploded buffer feature)
+   arcpy.MakeFeatureLayer_management (dissFeats, "dissFeatsLyr", "", "", "")
+   trashList.append("dissFeatsLyr")
+   
+   # Per-feature outputs, overwritten in each iteration
+   coalFeats = scratchGDB + os.sep + 'coalFeats'
+   noGapFeats = scratchGDB + os.sep + "noGapFeats"
+   trashList += [coalFeats, noGapFeats]
+   
+   # Read the dissolved features and their extents once. For each exploded buffer feature, candidates are found by 
+   # extent overlap, confirmed by geometry, and selected by ID, rather than running a spatial selection on the layer.
+   oidFld = arcpy.AddFieldDelimiters(dissFeats, arcpy.Describe(dissFeats).OIDFieldName)
+   with arcpy.da.SearchCursor(dissFeats, ["OID@", "SHAPE@"]) as sc:
+      diss = [(oid, shp, (shp.extent.XMin, shp.extent.YMin, shp.extent.XMax, shp.extent.YMax)) for oid, shp in sc]
+
    # Loop through the exploded buffer features
+   # The final geometries are collected, and inserted into the ShrinkWrap feature class after the loop with one cursor
+   # (so no write cursor is open while geoprocessing tools run)
    counter = 1
+   outShps = []
    with arcpy.da.SearchCursor(explFeats, ["SHAPE@"]) as myFeats:
       for Feat in myFeats:
          arcpy.AddMessage('Working on shrink feature %s' % str(counter))
          featSHP = Feat[0]
-         tmpFeat = scratchGDB + os.sep + "tmpFeat"
-         arcpy.CopyFeatures_management (featSHP, tmpFeat)
-         trashList.append(tmpFeat)
-         
-         # Process:  Repair Geometry
-         arcpy.RepairGeometry_management (tmpFeat, "DELETE_NULL")
-         
-         # Process:  Make Feature Layer
-         arcpy.MakeFeatureLayer_management (dissFeats, "dissFeatsLyr", "", "", "")
-         trashList.append("dissFeatsLyr")
 
-         # Process: Select Layer by Location (Get dissolved features within each exploded buffer feature)
-         arcpy.SelectLayerByLocation_management ("dissFeatsLyr", "INTERSECT", tmpFeat, "", "NEW_SELECTION")
+         # Process: Select Layer by Attribute (Get dissolved features within each exploded buffer feature)
+         e = featSHP.extent
+         xmin, ymin, xmax, ymax = e.XMin, e.YMin, e.XMax, e.YMax
+         oids = [str(oid) for oid, shp, x in diss 
+                 if x[0] <= xmax and x[2] >= xmin and x[1] <= ymax and x[3] >= ymin and not shp.disjoint(featSHP)]
+         if not oids:
+            counter +=1
+            continue
+         arcpy.SelectLayerByAttribute_management ("dissFeatsLyr", "NEW_SELECTION", "%s IN (%s)" % (oidFld, ",".join(oids)))
          
          # Process:  Coalesce features (expand)
-         coalFeats = scratchGDB + os.sep + 'coalFeats'
          Coalesce("dissFeatsLyr", smthMeas, coalFeats, scratchGDB)
          # Increasing the dilation distance improves smoothing and reduces the "dumbbell" effect.
-         trashList.append(coalFeats)
          
          # Eliminate gaps
-         noGapFeats = scratchGDB + os.sep + "noGapFeats"
          arcpy. EliminatePolygonPart_management (coalFeats, noGapFeats, "PERCENT", "", 99, "CONTAINED_ONLY")
          
-         # Process:  Append the final geometry to the ShrinkWrap feature class
-         arcpy.AddMessage("Appending feature...")
-         arcpy.Append_management(noGapFeats, outFeats, "NO_TEST", "", "")
+         # Process:  Keep the final geometry, for the ShrinkWrap feature class
+         outShps += [r[0] for r in arcpy.da.SearchCursor(noGapFeats, ["SHAPE@"])]
          
          counter +=1
          del Feat
 
+   # Process:  Append the final geometries to the ShrinkWrap feature class
+   arcpy.AddMessage("Appending features...")
+   with arcpy.da.InsertCursor(outFeats, ["SHAPE@"]) as outCur:
+      for shp in outShps:
+         outCur.insertRow([shp])
+
    # Cleanup
    if scratchGDB == "in_memory":
       garbagePickup(trashList)
@@ -377,8 +420,9 @@ def ProjectToMatch(in_Feats, in_Template, out_Feats):
    out_Feats = output features resulting from copy or reprojection
    '''
    
+   # input features are often temporary outputs, recreated between calls, so only the template is cached
    srFeats = arcpy.Describe(in_Feats).spatialReference
-   srTemplate = arcpy.Describe(in_Template).spatialReference
+   srTemplate = describeInfo(in_Template)[1]
    
    if srFeats.Name == srTemplate.Name:
       printMsg('Coordinate systems for features and template data are the same. Copying...')
@@ -10,8 +10,46 @@
 import Helper
 from Helper import *
 from arcpy.sa import *
+import multiprocessing
+try:
+   from scipy import ndimage
+except ImportError:
+   # SciPy is not included with older ArcGIS versions; reclassBarren then uses Spatial Analyst tools
+   ndimage = None
 arcpy.CheckOutExtension("Spatial")
 
+# Worker processes must run python.exe, rather than the application running this module (e.g. ArcMap)
+if os.name == 'nt':
+   multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'python.exe'))
+
+# Reclassification of reference rasters to likeliest barren transition (see reclassBarren), by schema
+REF_RCLS = {"1992": "0 NODATA;11 31;21 32;22 32;23 32;31 31;32 32;33 32;41 32;42 32;43 32;51 32;61 32;71 32;81 32;82 32;83 32;84 32;85 32;91 31;92 31",
+            "standard": "0 NODATA;11 31;21 32;22 32;23 32;24 32; 31 31;32 32;41 32;42 32;43 32;52 32;71 32;81 32;82 32;90 31;95 31"}
+
+# Cover class names, by code (see addCoverClass)
+NLCD_COVER = {0: "Unclassified",
+              11: "Open Water",
+              21: "Developed, Open Space",
+              22: "Developed, Low Intensity",
+              23: "Developed, Medium Intensity",
+              24: "Developed, High Intensity",
+              31: "Barren, Natural",
+              32: "Barren, Anthropogenic",
+              41: "Deciduous Forest",
+              42: "Evergreen Forest",
+              43: "Mixed Forest",
+              52: "Shrub/Scrub",
+              71: "Herbaceous",
+              81: "Hay/Pasture",
+              82: "Cultivated Crops",
+              90: "Woody Wetlands",
+              95: "Emergent Herbaceous Wetlands"}
+GEN_COVER = {0: "Undefined",
+             1: "Open Water",
+             2: "Developed",
+             3: "Agriculture",
+             4: "Natural",
+             5: "Successional"}
 
 def addCoverClass(inTab, schema):
    '''To input table, adds a field indicating cover classes for each code in the "Value" field.
@@ -21,50 +59,60 @@ def addCoverClass(inTab, schema):
    - schema: NLCD or Gen (general) codes [may want to add additional schemas at some point]
    '''
    
-   if schema == "NLCD":   
-      codeblock = '''def covClass(val):
-      d = {}
-      d[0] = "Unclassified"
-      d[11] = "Open Water"
-      d[21] = "Developed, Open Space"
-      d[22] = "Developed, Low Intensity"
-      d[23] = "Developed, Medium Intensity"
-      d[24] = "Developed, High Intensity"
-      d[31] = "Barren, Natural"
-      d[32] = "Barren, Anthropogenic"
-      d[41] = "Deciduous Forest"
-      d[42] = "Evergreen Forest"
-      d[43] = "Mixed Forest"
-      d[52] = "Shrub/Scrub"
-      d[71] = "Herbaceous"
-      d[81] = "Hay/Pasture"
-      d[82] = "Cultivated Crops"
-      d[90] = "Woody Wetlands"
-      d[95] = "Emergent Herbaceous Wetlands"
-      
-      return d[val]
-      '''
-   else:
-      codeblock = '''def covClass(val):
-      d = {}
-      d[0] = "Undefined"
-      d[1] = "Open Water"
-      d[2] = "Developed"
-      d[3] = "Agriculture"
-      d[4] = "Natural"
-      d[5] = "Successional"
-      
-      return d[val]
-      '''
-   expression = "covClass(!Value!)"
-   
-   arcpy.AddField_management(inTab, "CoverClass", "TEXT", "", "", 50)
-   arcpy.CalculateField_management(inTab, "CoverClass", expression, "PYTHON", codeblock)
+   d = NLCD_COVER if schema == "NLCD" else GEN_COVER
+   if "CoverClass" not in [f.name for f in arcpy.ListFields(inTab)]:
+      arcpy.AddField_management(inTab, "CoverClass", "TEXT", "", "", 50)
+   with arcpy.da.UpdateCursor(inTab, ["Value", "CoverClass"]) as curs:
+      for row in curs:
+         curs.updateRow((row[0], d.get(row[0], "")))
    
    return inTab
+
+def _clipMask(clipShp, template, outRast):
+   '''Rasterizes a clipping feature class on the grid of a template raster, for TabLcTypes. Cells within the features get the (non-zero) object ID; other cells are NoData.
+   
+   Parameters:
+   - clipShp: the clipping feature class
+   - template: raster providing the extent, cell size, and alignment
+   - outRast: the output mask raster
+   '''
+   oldExtent, oldSnap = arcpy.env.extent, arcpy.env.snapRaster
+   arcpy.env.extent = template
+   arcpy.env.snapRaster = template
+   try:
+      arcpy.PolygonToRaster_conversion(clipShp, arcpy.Describe(clipShp).OIDFieldName, outRast, "CELL_CENTER", "", template)
+   finally:
+      arcpy.env.extent, arcpy.env.snapRaster = oldExtent, oldSnap
+   return outRast
+
+def _clipAndCount(args):
+   '''Gets the pixel counts by value of a raster, for TabLcTypes, within a mask if applicable. Runs in a worker process, so it takes one argument.
+   
+   Without a mask, counts come from the raster attribute table. With a mask, the raster is read into arrays block by block, and values are counted where the mask has data; no clipped raster is written. NoData and 0 are not counted.
+   
+   Parameters (as a tuple):
+   - rast: the raster to be processed
+   - mask: mask raster from _clipMask, on the grid of rast, or None
+   '''
+   rast, mask = args
+   if not mask:
+      arr = arcpy.da.TableToNumPyArray (rast,["Value", "Count"], skip_nulls=True)
+      return arr["Value"], arr["Count"]
+   # Counts are accumulated block by block, so memory use is bounded
+   counts = numpy.zeros(256, dtype=numpy.int64)
+   for i, j, h, w, ll, i0, j0, rll, ncols, nrows in blockWindows(arcpy.Describe(rast)):
+      a = arcpy.RasterToNumPyArray(rast, ll, w, h, 0)
+      m = arcpy.RasterToNumPyArray(mask, ll, w, h, 0)
+      bc = numpy.bincount(a[m != 0].ravel(), minlength=len(counts)).astype(numpy.int64)
+      del a, m
+      bc[:len(counts)] += counts
+      counts = bc
+   counts[0] = 0
+   vals = numpy.flatnonzero(counts)
+   return vals, counts[vals]
     
-def TabLcTypes(rasterList, sumTab, clipShp = None):
-   '''Tabulates the amount and percent cover for each land cover type, for each input raster. Calculates the amount of change between the first year and the last year in the sequence. Optionally, clips the rasters prior to tabulation. Modifies the rasters' attributes tables.
+def TabLcTypes(rasterList, sumTab, clipShp = None, procs = None):
+   '''Tabulates the amount and percent cover for each land cover type, for each input raster. Calculates the amount of change between the first year and the last year in the sequence. Optionally, clips the rasters prior to tabulation. Modifies the rasters' attributes tables, if not clipping.
    
    Assumptions:
    - Input rasters are in GDB format, and all cover the exact same area. 
@@ -75,113 +123,235 @@ def TabLcTypes(rasterList, sumTab, clipShp = None):
    Parameters:
    - rasterList: a list of rasters to be processed. 
    - sumTab: output summary table   
-   - clipShp: an optional feature class used to clip each raster prior to calculating stats.
+   - clipShp: an optional feature class used to clip each raster prior to calculating stats. It is rasterized once, and used as a mask for all rasters. Clipped rasters are not written and their stats are only in the summary table.
+   - procs: number of processes used to clip and count the rasters. Defaults to one per raster, up to the number of CPUs. If 1, rasters are processed in this process.
    '''
    
    c = 0 # initialize counter
    y = [] # initialize list of years
-   for rast in rasterList:
-      name = os.path.basename(rast)
+   tabs = {} # initialize percent, hectares, and acres by value, by year
+   yrFlds = {} # initialize percent, hectares, and acres field names, by year
+   
+   # Rasterize clipShp once, for all rasters
+   if clipShp:
+      printMsg('Rasterizing clipping features...')
+      mask = _clipMask(clipShp, rasterList[0], arcpy.env.scratchGDB + os.sep + "tmpClipMask")
+   else:
+      mask = None
+   
+   # Clip (if applicable) and count pixels for all rasters; each raster is independent, so this is done in parallel
+   jobs = [(rast, mask) for rast in rasterList]
+   if procs is None:
+      procs = min(len(jobs), multiprocessing.cpu_count())
+   if clipShp:
+      printMsg('Clipping and counting pixels...')
+   else:
+      printMsg('Counting pixels...')
+   if procs > 1:
+      pool = multiprocessing.Pool(procs)
+      try:
+         results = pool.map(_clipAndCount, jobs)
+      finally:
+         pool.close()
+         pool.join()
+   else:
+      results = map(_clipAndCount, jobs)
+   if mask:
+      garbagePickup([mask])
+   
+   for rast, (vals, counts) in zip(rasterList, results):
       printMsg('Working on %s'%rast)
-      
-      if clipShp:
-         # Clip raster to clipShp, if applicable
-         printMsg('Clipping...')
-         rect = getRect(clipShp)
-         clipRast = rast + '_clp'
-         arcpy.Clip_management (rast, rect, clipRast, clipShp, "", "ClippingGeometry")
-      else: 
-         clipRast = rast
-      
       if c == 0:
-      # get total pixel count; only need to do this once
-         printMsg('Counting pixels...')
-         arr = arcpy.da.TableToNumPyArray (clipRast,["Value", "Count"], skip_nulls=True)
-         sum = arr["Count"].sum() 
-      
-      # determine year
-      name = os.path.basename(clipRast)
-      year = name[3:7]
-      
-      # add and calculate percent field
-      printMsg('Creating and calculating percent field...')
-      percFld = "Percent_%s"%year
-      arcpy.AddField_management(clipRast, percFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, percFld, "100*!Count!/%s"%sum, "PYTHON")
+      # get total pixel count, and its inverse (as percent) for the percent fields; only need to do this once
+      # (summed as 64-bit, since numpy's default integer is 32-bit on Windows)
+         sum = int(counts.sum(dtype=numpy.int64))
+         inv = 100.0/float(sum)
       
-      # add and calculate hectares field
-      printMsg('Creating and calculating hectares field...')
-      haFld = "Area_ha_%s"%year
-      arcpy.AddField_management(clipRast, haFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, haFld, "!Count!*0.09", "PYTHON")
+      # determine year, and its field names (used for the raster and the summary table)
+      year = os.path.basename(rast)[3:7]
+      yrFlds[year] = yf = ["Percent_%s"%year, "Area_ha_%s"%year, "Area_ac_%s"%year]
       
-      # add and calculate acres field
-      printMsg('Creating and calculating acres field...')
-      acFld = "Area_ac_%s"%year
-      arcpy.AddField_management(clipRast, acFld, "FLOAT")
-      arcpy.CalculateField_management(clipRast, acFld, "!Count!*0.2223948429", "PYTHON")
+      if not mask:
+         # add percent, hectares, and acres fields, and calculate them in one pass
+         printMsg('Creating and calculating percent, hectares, and acres fields...')
+         for fld in yf:
+            arcpy.AddField_management(rast, fld, "FLOAT")
+         with arcpy.da.UpdateCursor(rast, ["Count"] + yf) as uc:
+            for row in uc:
+               cnt = row[0]
+               uc.updateRow((cnt, cnt*inv, cnt*0.09, cnt*0.2223948429))
       
-      # make or append to summary table: year, percent, hectares, acres
-      path = os.path.dirname(sumTab)
-      name = os.path.basename(sumTab)
-
-      if c == 0:
-         printMsg('Creating summary table...')
-         arcpy.TableToTable_conversion(clipRast, path, name) 
-         arcpy.DeleteField_management(sumTab, "Count;Red;Green;Blue;Opacity")
-         
-      else:
-         printMsg('Appending to summary table...')
-         arcpy.JoinField_management (sumTab, "Value", clipRast, "Value", [percFld, haFld, acFld])
+      # keep the same values for the summary table, which is made once all rasters are done
+      cnt = counts.astype(numpy.float64)
+      tabs[year] = dict(zip(vals.tolist(), zip((cnt*inv).tolist(), (cnt*0.09).tolist(), (cnt*0.2223948429).tolist())))
       
       y.append(year) 
-      y.sort()
       c += 1 # update counter
    
    # determine start and end years and corresponding fields
-   c -= 1
-   startYear = y[0]
-   endYear = y[c]
-   
-   # Calculate change in hectares from start to end
-   startHa = "Area_ha_%s"%startYear
-   endHa = "Area_ha_%s"%endYear
-   printMsg('Creating and calculating hectares change field...')
-   arcpy.AddField_management(sumTab, "Change_ha", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_ha", "!%s! - !%s!"%(endHa,startHa), "PYTHON")
-   
-   # Calculate change in acres from start to end
-   startAc = "Area_ac_%s"%startYear
-   endAc = "Area_ac_%s"%endYear
-   printMsg('Creating and calculating acres change field...')
-   arcpy.AddField_management(sumTab, "Change_ac", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_ac", "!%s! - !%s!"%(endAc,startAc), "PYTHON")
-   
-   # Calculate percent change from start to end
-   printMsg('Creating and calculating change field...')
-   arcpy.AddField_management(sumTab, "Change_perc", "FLOAT")
-   arcpy.CalculateField_management(sumTab, "Change_perc", "100*(!%s! - !%s!)/!%s!"%(endHa,startHa,startHa), "PYTHON")
+   y.sort()
+   startYear, endYear = y[0], y[-1]
+   startHa, startAc = yrFlds[startYear][1:]
+   endHa, endAc = yrFlds[endYear][1:]
+   
+   # make summary table in memory: year, percent, hectares, acres, for all values in any year (types missing in a 
+   # year have no area)
+   printMsg('Creating summary table...')
+   values = sorted(set().union(*[t.keys() for t in tabs.values()]))
+   flds = [("Value", "<i4")]
+   for yr in y:
+      flds += [(fld, "<f4") for fld in yrFlds[yr]]
+   flds += [("Change_ha", "<f4"), ("Change_ac", "<f4"), ("Change_perc", "<f4")]
+   sumArr = numpy.zeros(len(values), dtype=flds)
+   sumArr["Value"] = values
+   for yr in y:
+      t = tabs[yr]
+      f = numpy.array([t.get(v, (0, 0, 0)) for v in values], dtype=numpy.float64).reshape(-1, 3)
+      for k, fld in enumerate(yrFlds[yr]):
+         sumArr[fld] = f[:, k]
+   
+   # Calculate change in hectares, acres, and percent from start to end
+   printMsg('Calculating change fields...')
+   ha0 = sumArr[startHa].astype(numpy.float64)
+   sumArr["Change_ha"] = sumArr[endHa] - ha0
+   sumArr["Change_ac"] = sumArr[endAc] - sumArr[startAc].astype(numpy.float64)
+   # percent change is undefined (null) for types not present in the start year
+   with numpy.errstate(divide='ignore', invalid='ignore'):
+      sumArr["Change_perc"] = numpy.where(ha0 != 0, 100*(sumArr[endHa] - ha0)/ha0, numpy.nan)
+   
+   # write summary table
+   if arcpy.Exists(sumTab):
+      arcpy.Delete_management(sumTab)
+   arcpy.da.NumPyArrayToTable(sumArr, sumTab)
      
    printMsg('Finished.')
    return sumTab
 
-def reclassBarren(refRast, schema, inRast, outRast, cmap = None): 
-   '''For NLCD data: reclassifies the 31 (Barren) land cover class to 31 (for "natural barrens") or 32 (for "anthropogenic barrens"), based on a reference raster from a prior year.
+def _rclsPairs(rclsTab):
+   '''Parses a reclassification table string (as used by Reclassify) to a list of (old, new) code pairs. NODATA is 0.
+   
    Parameters:
-   - refRast: input reference raster from a previous year
+   - rclsTab: reclassification table string, e.g. "0 NODATA;11 31"
+   '''
+   pairs = []
+   for item in rclsTab.split(";"):
+      old, new = item.split()
+      pairs.append((int(old), 0 if new == "NODATA" else int(new)))
+   return pairs
+
+def _buildLut(rclsTab):
+   '''Builds a lookup table (uint8 array of 256 values, indexed by code) from a reclassification table string, as used by the Reclassify tool. NODATA is 0, and codes not in the table are unchanged (as with Reclassify "DATA", in _reclassBarrenTools).
+   
+   Parameters:
+   - rclsTab: reclassification table string, e.g. "0 NODATA;11 31"
+   '''
+   lut = numpy.arange(256, dtype=numpy.uint8)
+   for old, new in _rclsPairs(rclsTab):
+      lut[old] = new
+   return lut
+
+# Lookup tables for REF_RCLS, for the array version of reclassBarren
+REF_RCLS_LUT = dict((k, _buildLut(v)) for k, v in REF_RCLS.items())
+
+def _majority3x3(a):
+   '''Applies a 3x3 majority filter to an array of 31/32 codes, ignoring NoData (0), as with FocalStatistics MAJORITY/DATA. Ties go to the lower value (31). Cells with no data in the window are 0.
+   
+   Parameters:
+   - a: array of 31, 32, or 0 (NoData)
+   '''
+   # Counts of each class in the windows (two box sums), rather than a Python function per window
+   win = numpy.ones((3, 3), dtype=numpy.uint8)
+   n31 = ndimage.convolve((a == 31).view(numpy.uint8), win, mode="constant")
+   n32 = ndimage.convolve((a == 32).view(numpy.uint8), win, mode="constant")
+   out = numpy.where(n31 >= n32, 31, 32).astype(numpy.uint8)
+   out[(n31 == 0) & (n32 == 0)] = 0
+   return out
+
+def _barrenArray(inArr, refArr, schema, cellSize):
+   '''Makes the array for reclassBarren, from arrays of the current and reference rasters, with NoData as 0. This does the same steps as the Spatial Analyst tools in _reclassBarrenTools, on arrays in memory.
+   
+   Parameters:
+   - inArr: array of the raster for which the barren class should be reclassified
+   - refArr: array of the reference raster, aligned with inArr
    - schema: classification schema of refRast (1992 or standard)
-   - inRast: the raster for which the barren class should be reclassified
-   - out Rast: the updated raster with the barren class split into two types   
+   - cellSize: cell size (meters)
    '''
-   # Reclassify reference raster to likeliest transition, only applicable IF the current raster is classed as barren. 
-   # Rationale: If it was forest and is now barren, it is probably due to clearing, e.g. for mining (anthropogenic). If it was agriculture and is now barren, it may be due to clearing for development (anthropogenic). If it was water or wetland and is now barren, it is probably simply due to the shifting mosaic of barrier island habitats, and is now sand (natural). Etc. 
-   # None of this matters if the current raster is anything other than 31.
+   # Reclassify with a lookup table: one gather, indexed by code
+   printMsg('Reclassifying reference raster...')
+   refRcls = REF_RCLS_LUT['1992' if schema == '1992' else 'standard'][refArr]
+   
+   # Apply a majority filter to the reclassified reference raster
+   printMsg('Applying majority filter...')
+   refFilt = _majority3x3(refRcls)
+   del refRcls
+   
+   # Expand the 31 class in the reclassified, filtered reference raster, by 3 cells
+   printMsg('Expanding 31 class...')
+   exp31 = numpy.where(ndimage.binary_dilation(refFilt == 31, structure=numpy.ones((3, 3), dtype=bool), iterations=3) & (refFilt != 0), 31, refFilt)
+   del refFilt
+   
+   # Get Euclidean distance to the 32 class in the reference raster; only whether it is less than 100 meters is kept
+   printMsg('Getting Euclidean distance to 32 class...')
+   if (refArr == 32).any():
+      close32 = ndimage.distance_transform_edt(refArr != 32) < 100.0/cellSize
+   else:
+      close32 = numpy.zeros(refArr.shape, dtype=bool)
+   
+   # Apply series of if/then statements to get final classification (see _reclassBarrenTools), in one expression.
+   # NoData in the reference raster is NoData in the output, for barren pixels.
+   printMsg('Applying final raster calculation...')
+   barren = numpy.where(refArr == 31, 31, numpy.where((refArr == 32) | close32, 32, exp31))
+   barren[refArr == 0] = 0
+   return numpy.where(inArr == 31, barren, inArr).astype(inArr.dtype)
 
-   refRast_rcls = refRast + '_rcls'
-   if schema == '1992':
-      rclsTab = "0 NODATA;11 31;21 32;22 32;23 32;31 31;32 32;33 32;41 32;42 32;43 32;51 32;61 32;71 32;81 32;82 32;83 32;84 32;85 32;91 31;92 31"
+# Margin (cells) for blocks of _barrenArray: majority filter (1) + expand (3). The 100m distance needs 100 / cell size 
+# cells, which is less for 30m cells.
+BARREN_HALO = 4
+
+def _tiled(fn, rasts, outRast, halo, tile = BLOCK_SIZE):
+   '''Applies an array function to rasters block by block, reading each block with a margin of halo cells for neighborhood operations, which is trimmed from the result. For rasters larger than one block, blocks are written to temporary rasters in the scratch workspace and mosaicked to the output. Builds the output's attribute table.
+   
+   Parameters:
+   - fn: function taking the arrays of a block (NoData as 0), one per input raster, returning an output array of the same shape (NoData as 0)
+   - rasts: list of input rasters. The first raster defines the processing window; others must be aligned with it.
+   - outRast: output raster
+   - halo: number of cells to add around each block. Must be at least the reach of any neighborhood operation in fn.
+   - tile: block size, in cells
+   '''
+   d = arcpy.Describe(rasts[0])
+   cw, ch = d.meanCellWidth, d.meanCellHeight
+   single = d.width <= tile and d.height <= tile
+   tiles = []
+   for i, j, h, w, ll, i0, j0, rll, ncols, nrows in blockWindows(d, tile, halo):
+      if not single:
+         printMsg('Processing block at row %s, column %s...'%(i, j))
+      arrs = [arcpy.RasterToNumPyArray(r, rll, ncols, nrows, 0) for r in rasts]
+      res = fn(*arrs)
+      del arrs
+      res = numpy.ascontiguousarray(res[i - i0:i - i0 + h, j - j0:j - j0 + w])
+      t = outRast if single else arcpy.env.scratchGDB + os.sep + "tmp_blk_%s_%s"%(i, j)
+      arcpy.NumPyArrayToRaster(res, ll, cw, ch, 0).save(t)
+      tiles.append(t)
+      pixType = PIXEL_TYPES[res.dtype.name]
+      del res
+   if single:
+      arcpy.DefineProjection_management(outRast, d.spatialReference)
    else:
-      rclsTab = "0 NODATA;11 31;21 32;22 32;23 32;24 32; 31 31;32 32;41 32;42 32;43 32;52 32;71 32;81 32;82 32;90 31;95 31"
+      printMsg('Mosaicking blocks...')
+      arcpy.MosaicToNewRaster_management(tiles, os.path.dirname(outRast), os.path.basename(outRast), d.spatialReference, pixType, cw, 1)
+      garbagePickup(tiles)
+      # the mosaic does not keep the blocks' NoData value (0), so it is set on the output
+      arcpy.SetRasterProperties_management(outRast, nodata="1 0")
+   arcpy.BuildRasterAttributeTable_management(outRast, "Overwrite")
+   return outRast
+
+def _reclassBarrenTools(refRast, schema, inRast, outRast):
+   '''Makes the raster for reclassBarren with Spatial Analyst tools, writing intermediate rasters alongside refRast. This is used if SciPy is not available.
+   
+   Parameters: see reclassBarren
+   '''
+   refRast_rcls = refRast + '_rcls'
+   rclsTab = REF_RCLS['1992' if schema == '1992' else 'standard']
    printMsg('Reclassifying reference raster...')
    arcpy.gp.Reclassify_sa(refRast, "Value", rclsTab, refRast_rcls, "DATA")
    
@@ -215,14 +385,36 @@ def reclassBarren(refRast, schema, inRast, outRast, cmap = None):
    #     Else if the reference pixel is 32: recode to 32
    #     Else if the distance to a reference pixel coded 32 is less than 100 meters: recode to 32
    #     Else: recode to the most likely transition, determined from the "exp31" raster
+   # The conditions are built once as map algebra objects, and the two reference tests for 32 are combined, so the 
+   # whole expression is evaluated in one pass.
    printMsg('Applying final raster calculation...')
    inRast = Raster(inRast)
    refRast = Raster(refRast)
    eDist32 = Raster(eDist32)
    exp31 = Raster(exp31)
    
-   expression = """Con("%s" == 31,Con("%s" == 31,31,Con("%s" == 32,32,Con("%s" < 100,32,"%s"))),"%s")"""%(inRast, refRast, refRast, eDist32, exp31, inRast)
-   arcpy.gp.RasterCalculator_sa(expression, outRast)
+   Con(inRast == 31, Con(refRast == 31, 31, Con((refRast == 32) | (eDist32 < 100), 32, exp31)), inRast).save(outRast)
+   return outRast
+
+def reclassBarren(refRast, schema, inRast, outRast, cmap = None): 
+   '''For NLCD data: reclassifies the 31 (Barren) land cover class to 31 (for "natural barrens") or 32 (for "anthropogenic barrens"), based on a reference raster from a prior year.
+   Parameters:
+   - refRast: input reference raster from a previous year
+   - schema: classification schema of refRast (1992 or standard)
+   - inRast: the raster for which the barren class should be reclassified
+   - out Rast: the updated raster with the barren class split into two types   
+   '''
+   # Reclassify reference raster to likeliest transition, only applicable IF the current raster is classed as barren. 
+   # Rationale: If it was forest and is now barren, it is probably due to clearing, e.g. for mining (anthropogenic). If it was agriculture and is now barren, it may be due to clearing for development (anthropogenic). If it was water or wetland and is now barren, it is probably simply due to the shifting mosaic of barrier island habitats, and is now sand (natural). Etc. 
+   # None of this matters if the current raster is anything other than 31.
+   
+   if ndimage is None:
+      _reclassBarrenTools(refRast, schema, inRast, outRast)
+   else:
+      # All steps are done on arrays in memory, block by block, with a margin for the neighborhood operations
+      cellSize = arcpy.Describe(inRast).meanCellWidth
+      halo = max(BARREN_HALO, int(numpy.ceil(100.0/cellSize)))
+      _tiled(lambda a, r: _barrenArray(a, r, schema, cellSize), [inRast, refRast], outRast, halo)
    
    # Add color map
    if cmap:
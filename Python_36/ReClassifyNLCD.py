@@ -32,207 +32,366 @@
 
 import arcpy
 import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy
+from scipy import ndimage
+from scipy import fft as sfft
 from arcpy.sa import *
 
-# begin variables
-
-# working directory (project folder created here)
-wd = r'D:\scratch\arc_wd'
-# project folder name
-project_nm = 'nlcd_2011'
-
-# study extent
-extent_shp = r'D:\SDM\all_projects\_data\other_spatial\feature\sdmVA_pred_20170131_10kmBuff.shp'
-
-# input raster(s). Set None for ones not used
-nlcd_classified = r'L:\David\GIS_data\NLCD\nlcd_2016\nlcd_2016ed_LandCover_albers.gdb\lc_2016'
-impervious_raster = r'L:\David\GIS_data\NLCD\nlcd_2016\nlcd_2016ed_Impervious_albers.gdb\imperv_2016'
-# canopy_raster = r'L:\David\GIS_data\NLCD\treecan2016.tif\treecan2016.tif'
-
-# mask, also used as the snap raster and output CRS
-mask = r'E:\projects\SDM_ancilliary\Hypergrid\VA_methods\raster\_masks\data_mask.tif'
-
-# end variables
-
-# make output dir/processing gdb
-project_dir = wd + os.sep + project_nm
-try:
-   os.mkdir(project_dir)
-except:
-   print("Folder already exists. This will overwrite existing files in the folder.")
-try:
-   out_gdb = arcpy.CreateFileGDB_management(project_dir, project_nm + "_processing")
-except:
-   print("Processing gdb already exists. This will overwrite existing files in the gdb.")
-   out_gdb = project_dir + os.sep + project_nm + "_processing.gdb"
-
-# set environmental variables
-arcpy.CheckOutExtension("Spatial")
-arcpy.env.workspace = str(out_gdb)
-arcpy.env.overwriteOutput = True
-arcpy.env.snapRaster = mask
-arcpy.env.outputCoordinateSystem = mask
-arcpy.env.cellSize = mask
-
-# buffer extent feature
-# skip if already buffered
-# extent_shp = arcpy.Buffer_analysis(in_features=extent_shp, out_feature_class="nlcdprocextent",
-#                                    buffer_distance_or_field="5000 Meters", dissolve_option="ALL")
-# arcpy.env.extent = extent_shp (not necessary)
-
-# clean (clip and set null) rasters (NA values are different for each layer)
-# nlcd classified
-in_nlcd = arcpy.Clip_management(nlcd_classified, "#", "nlcdcliptemp", extent_shp, "#", "ClippingGeometry")
-where_clause = "Value = 0"
-outsetNull = SetNull("nlcdcliptemp", "nlcdcliptemp", where_clause)
-outsetNull.save("landcover_classified_clean")
-in_nlcd_class = "landcover_classified_clean"
-
-# impervious
-if impervious_raster:
-   in_nlcd = arcpy.Clip_management(impervious_raster, "#", "nlcdcliptemp", extent_shp, "#", "ClippingGeometry")
-   where_clause = "Value = 127"
-   outsetNull = SetNull("nlcdcliptemp", "nlcdcliptemp", where_clause)
-   outsetNull.save("impsur")
-   in_impervious = "impsur"
-
-# canopy
-if canopy_raster:
-   in_nlcd = arcpy.Clip_management(canopy_raster, "#", "nlcdcliptemp", extent_shp, "#", "ClippingGeometry")
-   where_clause = "Value = 255"
-   outsetNull = SetNull("nlcdcliptemp", "nlcdcliptemp", where_clause)
-   outsetNull.save("canopy")
-   in_canopy = "canopy"
-
-arcpy.Delete_management("nlcdcliptemp")
-##Step 0: Set up the Remap Values
-
-# Raster values and their associated habitat in the NLCD
-# 11 = Open Water
-# 12 = Perennial Ice/Snow
-# 21 = Developed Open Space
-# 22 = Developed Low Intensity
-# 23 = Developed Medium Intensity
-# 24 = Developed High Intensity
-# 31 = Barren Land
-# 41 = Deciduous Forest
-# 42 = Evergreen Forest
-# 43 = Mixed Forest
-# 52 = Shrub/Scrub
-# 71 = Grassland/Herbaceous
-# 81 = Pasture/Hay
-# 82 = Cultivated Crops
-# 90 = Woody Wetlands
-# 95 = Emergent Herbaceous Wetlands
-
-# For Forest we only want values 41,42,43
-# remap_forest = RemapValue(
-#    [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 1], [42, 1], [43, 1], [52, 0], [71, 0], [81, 0],
-#     [82, 0], [90, 0], [95, 0]])
-
-# For Wetland we only want 90 and 95
-remap_wetland = RemapValue(
-   [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 0], [71, 0], [81, 0],
-    [82, 0], [90, 1], [95, 1]])
-
-# For Open Area we want 31, 71,81,82
-remap_Open = RemapValue(
-   [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 1], [41, 0], [42, 0], [43, 0], [52, 0], [71, 1], [81, 1],
-    [82, 1], [90, 0], [95, 0]])
-
-# For Water we want 11
-remap_water = RemapValue(
-   [[11, 1], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 0], [71, 0], [81, 0],
-    [82, 0], [90, 0], [95, 0]])
-
-# For ShrubScrub we want 52
-remap_ShrubScrub = RemapValue(
-   [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 1], [71, 0], [81, 0],
-    [82, 0], [90, 0], [95, 0]])
-
-# For ConiferForest we want 42
-# remap_evergreen = RemapValue(
-#    [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 1], [43, 0], [52, 0], [71, 0], [81, 0],
-#     [82, 0], [90, 0], [95, 0]])
-
-# For Deciduous/Mix we want 41 and 43 and we want 43 half as much so 41->100 and 43->50
-remap_decidmix = RemapValue(
-   [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 100], [42, 0], [43, 50], [52, 0], [71, 0],
-    [81, 0], [82, 0], [90, 0], [95, 0]])
-
-# For Evergreen/Mix we want 42 and 43 and we want 43 half as much so 42->100 and 43->50
-remap_evermix = RemapValue(
-   [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 100], [43, 50], [52, 0], [71, 0],
-    [81, 0], [82, 0], [90, 0], [95, 0]])
-
-# Step 2 - Reclass the rasters for each desired land type
-reclass_field = "Value"
-
-# out_reclassify_forest = Reclassify(in_nlcd_class, reclass_field, remap_forest, "NODATA")
-# out_reclassify_forest.save(project_nm + "_b_forest_n")
-
-out_reclassify_wetland = Reclassify(in_nlcd_class, reclass_field, remap_wetland, "NODATA")
-out_reclassify_wetland.save('nlcdwet')
-
-out_reclassify_open = Reclassify(in_nlcd_class, reclass_field, remap_Open, "NODATA")
-out_reclassify_open.save('nlcdopn')
-
-out_reclassify_water = Reclassify(in_nlcd_class, reclass_field, remap_water, "NODATA")
-out_reclassify_water.save('nlcdwat')
-
-out_reclassify_ShrubScrub = Reclassify(in_nlcd_class, reclass_field, remap_ShrubScrub, "NODATA")
-out_reclassify_ShrubScrub.save('nlcdshb')
-
-#########Added 2017 - Split the forest into evergreen/mixed forest and deciduous/mixed forest
-
-# out_reclassify_Evergreen = Reclassify(in_nlcd_class, reclass_field, remap_evergreen, "NODATA")
-# out_reclassify_Evergreen.save(project_nm + "_b_evergreen_n")
-
-out_reclassify_decidmix = Reclassify(in_nlcd_class, reclass_field, remap_decidmix, "NODATA")
-out_reclassify_decidmix.save('nlcddfr')
-
-out_reclassify_Evermix = Reclassify(in_nlcd_class, reclass_field, remap_evermix, "NODATA")
-out_reclassify_Evermix.save('nlcdefr')
-
-print("done reclassifying")
-# Step 3: Calculate focal statistics
-
-# get list of binary rasters and add impervious and canopy if necessary
-proj_source = ['nlcdwet', 'nlcdopn', 'nlcdwat', 'nlcdshb', 'nlcddfr', 'nlcdefr']
-if impervious_raster:
-   proj_source.append(in_impervious)
-if canopy_raster:
-   proj_source.append(in_canopy)
-
-# focal neighborhood names and types
-ngb_nm = ['1', '10', '100']
-ngb_type = [NbrRectangle(3, 3, "CELL"), NbrCircle(10, "CELL"), NbrCircle(100, "CELL")]
-ngb_ls = [i for i in range(0, len(ngb_nm))]
-
-for raster in proj_source:
-   print("Calculating focal statistics for " + raster + "...")
-
-   for n in ngb_ls:
-      out_raster = project_dir + os.sep + raster + ngb_nm[n] + '.tif'
-      type = ngb_type[n]
-      print("Calculating neighborhood " + ngb_nm[n] + "...")
-      outFocal = FocalStatistics(raster, type, "MEAN", "DATA")
-      outFocal = Con(IsNull(outFocal), 0, outFocal)
-      outFocal = ExtractByMask(outFocal, mask)
-      if raster in ['impsur', 'canopy', 'nlcddfr', 'nlcdefr']:
-         # these have initial max value of 100
-         outFocal = Int((outFocal * 100) + 0.5)
-      else:
-         # these have initial max value of 1
-         outFocal = Int((outFocal * 10000) + 0.5)
-      outFocal.save(out_raster)
-      print("Finished with neighborhood " + ngb_nm[n] + ".")
-
-   print("Finished with " + raster + ".")
-
-## clean up
-if arcpy.Exists("maskfinal"):
-   arcpy.Delete_management("maskfinal")
-arcpy.Delete_management("nlcdprocextent")
-
-arcpy.BuildPyramidsandStatistics_management(project_dir)
+# Rows per strip for array passes; strips of a CONUS-width clip stay within a few MB
+STRIP_ROWS = 256
+
+# Array value used for NoData in uint8 rasters
+NODATA_U8 = 255
+
+# Array value used for NoData in the (int16) focal outputs
+NODATA_I16 = -1
+
+# Tile size (cells) for focal means; tiles are read with a margin of the neighborhood radius
+FOCAL_TILE = 2048
+
+# Kernels up to this many cells are convolved directly; larger ones by FFT
+DIRECT_KERNEL_MAX = 25
+
+# Kernel spectra for FFT focal means (see _kernelFft), by neighborhood (shape, size)
+KERNEL_CACHE = {}
+
+
+def remapLut(pairs):
+   '''Builds a uint8 lookup table (256 values, indexed by NLCD code) from a list of [code, value] pairs, as used by
+   RemapValue. Codes not in the list, and the NoData value, are NoData (as for Reclassify with "NODATA").'''
+   lut = numpy.full(256, NODATA_U8, dtype=numpy.uint8)
+   for code, val in pairs:
+      lut[code] = val
+   return lut
+
+
+def rasterGeo(rast):
+   '''Returns the georeferencing (lower left, cell width, cell height, spatial reference) of a raster.'''
+   d = arcpy.Describe(rast)
+   return d.extent.lowerLeft, d.meanCellWidth, d.meanCellHeight, d.spatialReference
+
+
+def saveArray(arr, geo, out_raster, nodata=NODATA_U8):
+   '''Saves an array to a raster with the georeferencing from rasterGeo.'''
+   ll, cw, ch, sr = geo
+   arcpy.NumPyArrayToRaster(arr, ll, cw, ch, nodata).save(out_raster)
+   arcpy.DefineProjection_management(out_raster, sr)
+   return out_raster
+
+
+def readArray(rast, geo, shape, nodata=NODATA_U8):
+   '''Reads a raster to an array on the window given by georeferencing from rasterGeo and an array shape.'''
+   return arcpy.RasterToNumPyArray(rast, geo[0], shape[1], shape[0], nodata_to_value=nodata)
+
+
+def newArray(shape, dtype, path=None):
+   '''Returns a new array or, given a path, a new .npy file opened as a memory-mapped array. Worker processes open
+   these files (numpy.load with mmap_mode) and read only the slices they use, instead of being sent copies.'''
+   if path is None:
+      return numpy.empty(shape, dtype=dtype)
+   return numpy.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+
+
+def npyPath(npy_dir, name):
+   return npy_dir + os.sep + name + '.npy'
+
+
+def reclassLuts(in_raster, luts, npy_dir=None):
+   '''Reclassifies a uint8 raster with several lookup tables in one read. The raster is read to an array once, and each
+   strip of rows is looked up in all tables while it is in cache. Returns a dict of output arrays (name: array), and
+   the georeferencing of the input. Given npy_dir, outputs are memory-mapped .npy files there, named by table.'''
+   arr = arcpy.RasterToNumPyArray(in_raster, nodata_to_value=NODATA_U8)
+   out = {nm: newArray(arr.shape, numpy.uint8, npy_dir and npyPath(npy_dir, nm)) for nm in luts}
+   for i in range(0, arr.shape[0], STRIP_ROWS):
+      strip = arr[i:i + STRIP_ROWS]
+      for nm, lut in luts.items():
+         numpy.take(lut, strip, out=out[nm][i:i + STRIP_ROWS])
+   return out, rasterGeo(in_raster)
+
+
+def nbrKernel(shape, size):
+   '''Returns the weights (1 in the neighborhood, else 0) for a focal neighborhood, matching NbrRectangle(size, size,
+   "CELL") for shape 'rect', or NbrCircle(size, "CELL") for shape 'circle' (cells with centers within the radius).'''
+   if shape == 'rect':
+      return numpy.ones((size, size), dtype=numpy.uint8)
+   y, x = numpy.ogrid[-size:size + 1, -size:size + 1]
+   return (x * x + y * y <= size * size).astype(numpy.uint8)
+
+
+def _kernelFft(ngb, kernel):
+   '''Returns the FFT shape and spectrum of a neighborhood kernel, for tiles of FOCAL_TILE cells plus margins (the
+   same for every tile). Cached in KERNEL_CACHE by neighborhood, so each is computed once per process and reused for
+   the sums and counts of all tiles and rasters.'''
+   if ngb not in KERNEL_CACHE:
+      n = sfft.next_fast_len(FOCAL_TILE + 2 * (kernel.shape[0] - 1), real=True)
+      KERNEL_CACHE[ngb] = ((n, n), sfft.rfft2(kernel, (n, n)))
+   return KERNEL_CACHE[ngb]
+
+
+def _focalSums(arrs, ngb, kernel):
+   # neighborhood sums of each (uint8) array, aligned with the array, with zeros outside it (so edge cells only count
+   # data inside the array). Arrays are only widened for the sums: to int32 for direct sums, or to float64 within the
+   # FFT.
+   if kernel.size <= DIRECT_KERNEL_MAX:
+      return [ndimage.correlate(a, kernel, output=numpy.int32, mode='constant', cval=0) for a in arrs]
+   r = kernel.shape[0] // 2
+   fshape, kfft = _kernelFft(ngb, kernel)
+   return [sfft.irfft2(sfft.rfft2(a, fshape) * kfft, fshape)[r:r + a.shape[0], r:r + a.shape[1]] for a in arrs]
+
+
+def tileWindows(shape, tile=None):
+   '''Yields the tiles (first row, first column, number of rows, number of columns) covering an array shape. Tiles are
+   FOCAL_TILE square unless given.'''
+   tile = tile or FOCAL_TILE
+   for i in range(0, shape[0], tile):
+      for j in range(0, shape[1], tile):
+         yield i, j, min(tile, shape[0] - i), min(tile, shape[1] - j)
+
+
+def focalTile(arr, win, ngb, kernel, mask_arr, scale, nodata=NODATA_U8):
+   '''Calculates the focal mean for one tile of an array, equivalent to FocalStatistics (MEAN, ignoring NoData), then
+   setting cells with no data in the neighborhood to 0, ExtractByMask, and Int(x * scale + 0.5). The mean is the sum of
+   data cells over their count; inputs are integers, so both are rounded to exact integers after the convolution. Only
+   the tile and a margin of the kernel radius are read, so the array can be memory-mapped. Returns an int16 array for
+   the tile, with NoData (outside the mask) as NODATA_I16.
+
+   The tile is given as from tileWindows, and the neighborhood as (shape, size) with its kernel from nbrKernel.'''
+   i, j, h, w = win
+   r = kernel.shape[0] // 2
+   nrows, ncols = arr.shape
+   i0, j0 = max(i - r, 0), max(j - r, 0)
+   a = numpy.asarray(arr[i0:min(i + h + r, nrows), j0:min(j + w + r, ncols)])
+   valid = a != nodata
+   tot, cnt = _focalSums([numpy.where(valid, a, numpy.uint8(0)), valid.view(numpy.uint8)], ngb, kernel)
+   tot = numpy.rint(tot[i - i0:i - i0 + h, j - j0:j - j0 + w])
+   cnt = numpy.rint(cnt[i - i0:i - i0 + h, j - j0:j - j0 + w])
+   mean = numpy.divide(tot, cnt, out=numpy.zeros_like(tot), where=cnt > 0)
+   return numpy.where(mask_arr[i:i + h, j:j + w], numpy.floor(mean * scale + 0.5), NODATA_I16).astype(numpy.int16)
+
+
+def focalMeanInt(arr, ngb, mask_arr, scale, nodata=NODATA_U8):
+   '''Calculates the focal mean (see focalTile) of a whole array, tile by tile, so FFT buffers stay small. Returns an
+   int16 array. The neighborhood is given as (shape, size), for nbrKernel.'''
+   kernel = nbrKernel(*ngb)
+   out = numpy.empty(arr.shape, dtype=numpy.int16)
+   for i, j, h, w in tileWindows(arr.shape):
+      out[i:i + h, j:j + w] = focalTile(arr, (i, j, h, w), ngb, kernel, mask_arr, scale, nodata)
+   return out
+
+
+def focalTileJob(win, srcs, ngbs, mask_npy, scales, outs):
+   '''Runs focalTile for one tile of every input and neighborhood, in a worker process. Inputs (.npy files, with their
+   scales) and outputs (.npy files, by input then neighborhood) are memory-mapped, and only this tile (with its
+   margin) is read or written, so workers share the files without copies. Neighborhoods are given as (shape, size),
+   since arcpy neighborhoods and kernels are rebuilt in the worker. Returns the tile.'''
+   mask_arr = numpy.load(mask_npy, mmap_mode='r')
+   kernels = [nbrKernel(*ngb) for ngb in ngbs]
+   for src, scale, src_outs in zip(srcs, scales, outs):
+      arr = numpy.load(src, mmap_mode='r')
+      for ngb, kernel, out_npy in zip(ngbs, kernels, src_outs):
+         out = numpy.load(out_npy, mmap_mode='r+')
+         out[win[0]:win[0] + win[2], win[1]:win[1] + win[3]] = focalTile(arr, win, ngb, kernel, mask_arr, scale)
+         out.flush()
+         del out
+   return win
+
+
+def main():
+   # begin variables
+
+   # working directory (project folder created here)
+   wd = r'D:\scratch\arc_wd'
+   # project folder name
+   project_nm = 'nlcd_2011'
+
+   # study extent
+   extent_shp = r'D:\SDM\all_projects\_data\other_spatial\feature\sdmVA_pred_20170131_10kmBuff.shp'
+
+   # input raster(s). Set None for ones not used
+   nlcd_classified = r'L:\David\GIS_data\NLCD\nlcd_2016\nlcd_2016ed_LandCover_albers.gdb\lc_2016'
+   impervious_raster = r'L:\David\GIS_data\NLCD\nlcd_2016\nlcd_2016ed_Impervious_albers.gdb\imperv_2016'
+   # canopy_raster = r'L:\David\GIS_data\NLCD\treecan2016.tif\treecan2016.tif'
+   canopy_raster = None
+
+   # mask, also used as the snap raster and output CRS
+   mask = r'E:\projects\SDM_ancilliary\Hypergrid\VA_methods\raster\_masks\data_mask.tif'
+
+   # end variables
+
+   # make output dir/processing gdb
+   project_dir = wd + os.sep + project_nm
+   try:
+      os.mkdir(project_dir)
+   except:
+      print("Folder already exists. This will overwrite existing files in the folder.")
+   try:
+      out_gdb = arcpy.CreateFileGDB_management(project_dir, project_nm + "_processing")
+   except:
+      print("Processing gdb already exists. This will overwrite existing files in the gdb.")
+      out_gdb = project_dir + os.sep + project_nm + "_processing.gdb"
+
+   # set environmental variables
+   arcpy.CheckOutExtension("Spatial")
+   arcpy.env.workspace = str(out_gdb)
+   arcpy.env.overwriteOutput = True
+   arcpy.env.snapRaster = mask
+   arcpy.env.outputCoordinateSystem = mask
+   arcpy.env.cellSize = mask
+
+   # buffer extent feature
+   # skip if already buffered
+   # extent_shp = arcpy.Buffer_analysis(in_features=extent_shp, out_feature_class="nlcdprocextent",
+   #                                    buffer_distance_or_field="5000 Meters", dissolve_option="ALL")
+   # arcpy.env.extent = extent_shp (not necessary)
+
+   # clean (clip and set null) rasters (NA values are different for each layer). The extent and mask environments
+   # clip to the study extent within each Con, so there is no separate clipped raster.
+   # headsup: these are saved to the processing gdb, not the memory workspace, since the mask will not work correctly
+   # with a memory workspace (at least in Pro 3.1.2)
+   with arcpy.EnvManager(extent=extent_shp, mask=extent_shp):
+      # nlcd classified
+      in_nlcd_class = "landcover_classified_clean"
+      Con(Raster(nlcd_classified) != 0, nlcd_classified).save(in_nlcd_class)
+
+      # impervious
+      if impervious_raster:
+         in_impervious = "impsur"
+         Con(Raster(impervious_raster) != 127, impervious_raster).save(in_impervious)
+
+      # canopy
+      if canopy_raster:
+         in_canopy = "canopy"
+         Con(Raster(canopy_raster) != 255, canopy_raster).save(in_canopy)
+
+   ##Step 0: Set up the Remap Values
+
+   # Raster values and their associated habitat in the NLCD
+   # 11 = Open Water
+   # 12 = Perennial Ice/Snow
+   # 21 = Developed Open Space
+   # 22 = Developed Low Intensity
+   # 23 = Developed Medium Intensity
+   # 24 = Developed High Intensity
+   # 31 = Barren Land
+   # 41 = Deciduous Forest
+   # 42 = Evergreen Forest
+   # 43 = Mixed Forest
+   # 52 = Shrub/Scrub
+   # 71 = Grassland/Herbaceous
+   # 81 = Pasture/Hay
+   # 82 = Cultivated Crops
+   # 90 = Woody Wetlands
+   # 95 = Emergent Herbaceous Wetlands
+
+   # For Forest we only want values 41,42,43
+   # remap_forest = RemapValue(
+   #    [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 1], [42, 1], [43, 1], [52, 0], [71, 0], [81, 0],
+   #     [82, 0], [90, 0], [95, 0]])
+
+   # For Wetland we only want 90 and 95
+   remap_wetland = [
+      [11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 0], [71, 0], [81, 0],
+      [82, 0], [90, 1], [95, 1]]
+
+   # For Open Area we want 31, 71,81,82
+   remap_Open = [
+      [11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 1], [41, 0], [42, 0], [43, 0], [52, 0], [71, 1], [81, 1],
+      [82, 1], [90, 0], [95, 0]]
+
+   # For Water we want 11
+   remap_water = [
+      [11, 1], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 0], [71, 0], [81, 0],
+      [82, 0], [90, 0], [95, 0]]
+
+   # For ShrubScrub we want 52
+   remap_ShrubScrub = [
+      [11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 0], [43, 0], [52, 1], [71, 0], [81, 0],
+      [82, 0], [90, 0], [95, 0]]
+
+   # For ConiferForest we want 42
+   # remap_evergreen = RemapValue(
+   #    [[11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 1], [43, 0], [52, 0], [71, 0], [81, 0],
+   #     [82, 0], [90, 0], [95, 0]])
+
+   # For Deciduous/Mix we want 41 and 43 and we want 43 half as much so 41->100 and 43->50
+   remap_decidmix = [
+      [11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 100], [42, 0], [43, 50], [52, 0], [71, 0],
+      [81, 0], [82, 0], [90, 0], [95, 0]]
+
+   # For Evergreen/Mix we want 42 and 43 and we want 43 half as much so 42->100 and 43->50
+   remap_evermix = [
+      [11, 0], [12, 0], [21, 0], [22, 0], [23, 0], [24, 0], [31, 0], [41, 0], [42, 100], [43, 50], [52, 0], [71, 0],
+      [81, 0], [82, 0], [90, 0], [95, 0]]
+
+   # Step 2 - Reclass the rasters for each desired land type, in one pass over the classified raster
+   # (outputs are NoData where the input is NoData, or a code not in the remap)
+   luts = {'nlcdwet': remapLut(remap_wetland), 'nlcdopn': remapLut(remap_Open), 'nlcdwat': remapLut(remap_water),
+           'nlcdshb': remapLut(remap_ShrubScrub), 'nlcddfr': remapLut(remap_decidmix), 'nlcdefr': remapLut(remap_evermix)}
+   # arrays are kept in memory-mapped files, for the focal workers
+   npy_dir = project_dir + os.sep + 'npy'
+   os.makedirs(npy_dir, exist_ok=True)
+   rcls_arrs, rcls_geo = reclassLuts(in_nlcd_class, luts, npy_dir)
+   shape = rcls_arrs['nlcdwet'].shape
+   for a in rcls_arrs.values():
+      a.flush()
+   del rcls_arrs
+
+   print("done reclassifying")
+   # Step 3: Calculate focal statistics
+   # (the mean, fill, mask, and integer steps are done together on arrays, and each output is written once)
+
+   # get list of binary rasters and add impervious and canopy if necessary
+   # (arrays are all read on the grid of the classified raster)
+   proj_source = ['nlcdwet', 'nlcdopn', 'nlcdwat', 'nlcdshb', 'nlcddfr', 'nlcdefr']
+   if impervious_raster:
+      proj_source.append('impsur')
+      numpy.save(npyPath(npy_dir, 'impsur'), readArray(in_impervious, rcls_geo, shape))
+   if canopy_raster:
+      proj_source.append('canopy')
+      numpy.save(npyPath(npy_dir, 'canopy'), readArray(in_canopy, rcls_geo, shape))
+   mask_npy = npyPath(npy_dir, 'mask')
+   numpy.save(mask_npy, readArray(IsNull(mask), rcls_geo, shape, nodata=1) == 0)
+
+   # focal neighborhood names and types (shape, size), for nbrKernel
+   ngb_nm = ['1', '10', '100']
+   ngb_type = [('rect', 3), ('circle', 10), ('circle', 100)]
+
+   # The domain is split into tiles, and each worker computes all rasters and neighborhoods for a tile, reading only
+   # the tile and its margin (see focalTileJob). Outputs are memory-mapped .npy files, filled in by tile, then
+   # written here.
+   scale = [100 if raster in ['impsur', 'canopy', 'nlcddfr', 'nlcdefr'] else 10000 for raster in proj_source]
+   srcs = [npyPath(npy_dir, raster) for raster in proj_source]
+   outs = [[npyPath(npy_dir, raster + nm) for nm in ngb_nm] for raster in proj_source]
+   for raster_outs in outs:
+      for out_npy in raster_outs:
+         newArray(shape, numpy.int16, out_npy).flush()
+   tiles = list(tileWindows(shape))
+   print("Calculating focal statistics for " + str(len(proj_source)) + " rasters and " + str(len(ngb_nm)) +
+         " neighborhoods, in " + str(len(tiles)) + " tiles...")
+   workers = min(len(tiles), max(1, os.cpu_count() // 2))
+   run = partial(focalTileJob, srcs=srcs, ngbs=ngb_type, mask_npy=mask_npy, scales=scale, outs=outs)
+   with ProcessPoolExecutor(max_workers=workers) as ex:
+      for k, win in enumerate(ex.map(run, tiles)):
+         print("Finished tile " + str(k + 1) + " of " + str(len(tiles)) + ".")
+   for raster, raster_outs in zip(proj_source, outs):
+      for nm, out_npy in zip(ngb_nm, raster_outs):
+         out_raster = project_dir + os.sep + raster + nm + '.tif'
+         outFocal = numpy.load(out_npy, mmap_mode='r')
+         saveArray(outFocal, rcls_geo, out_raster, NODATA_I16)
+         del outFocal
+         print("Finished with " + raster + ", neighborhood " + nm + ".")
+   shutil.rmtree(npy_dir)
+
+   ## clean up
+   if arcpy.Exists("maskfinal"):
+      arcpy.Delete_management("maskfinal")
+   arcpy.Delete_management("nlcdprocextent")
+
+   arcpy.BuildPyramidsandStatistics_management(project_dir)
+
+
+if __name__ == '__main__':
+   main()
@@ -238,12 +238,13 @@ for yr in yrs:
          type = ngb_type[n]
          print("Calculating neighborhood " + ngb_nm[n] + "...")
          outFocal = FocalStatistics(raster, type, "MEAN", "DATA")
-         outFocal = Con(IsNull(outFocal), 0, outFocal)
-         outFocal = ExtractByMask(outFocal, mask)
          if raster in ['impsur', 'canopy', 'nlcddfr', 'nlcdefr']:
             outFocal = Int((outFocal * 100) + 0.5)
          else:
             outFocal = Int((outFocal * 10000) + 0.5)
+         # NoData (no data in neighborhood) is filled with 0 and masked in one pass, using the mask environment
+         with arcpy.EnvManager(mask=mask):
+            outFocal = Con(IsNull(outFocal), 0, outFocal)
          outFocal.save(out_raster)
          print("Finished with neighborhood " + ngb_nm[n] + ".")
 
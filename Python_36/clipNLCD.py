@@ -10,8 +10,69 @@
 # Created on: 2021-07-30
 import arcpy
 import os
+import sys
 import zipfile
 import time
+from concurrent.futures import ThreadPoolExecutor
+# shared block iteration (blockWindows, BLOCK_SIZE, PIXEL_TYPES) is in Helper.py, in the folder above this one
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from Helper import blockWindows, BLOCK_SIZE, PIXEL_TYPES
+
+
+# Template grid and mask array (True outside the mask), by template raster (see templateMask)
+_maskCache = {}
+
+
+def templateMask(template_mask):
+   '''Gets the Describe object and the mask array (True where the template is NoData) of a template raster, reading
+   the mask only on the first call. clipNLCD is run for each year and product with the same template, so the mask is
+   read once and shared by all of them. Templates are assumed not to change during the session.'''
+   if template_mask not in _maskCache:
+      d = arcpy.Describe(template_mask)
+      isnull = arcpy.RasterToNumPyArray(arcpy.sa.IsNull(template_mask), d.extent.lowerLeft, d.width, d.height,
+                                        nodata_to_value=1).astype(bool)
+      _maskCache[template_mask] = (d, isnull)
+   return _maskCache[template_mask]
+
+
+def sameGrid(rast, template):
+   '''Checks whether a raster is on the grid of a template (same coordinate system and cell size, with cell edges
+   aligned), so it can be read directly in the template's window.'''
+   d, t = arcpy.Describe(rast), templateMask(template)[0]
+   if d.spatialReference.factoryCode != t.spatialReference.factoryCode or d.spatialReference.name != t.spatialReference.name:
+      return False
+   if d.meanCellWidth != t.meanCellWidth or d.meanCellHeight != t.meanCellHeight:
+      return False
+   dx = (t.extent.XMin - d.extent.XMin) / d.meanCellWidth
+   dy = (t.extent.YMax - d.extent.YMax) / d.meanCellHeight
+   return abs(dx - round(dx)) < 1e-6 and abs(dy - round(dy)) < 1e-6
+
+
+def extractByMaskBlocks(in_rast, template_mask, out_rast, block=BLOCK_SIZE):
+   '''Equivalent to ExtractByMask on the template's grid, for an input on the same grid. The input is read in blocks
+   of the template's window (so only the clipped area is read), cells where the template is NoData are set to
+   NoData, and the blocks are mosaicked to the output. Memory use is bounded by the block size, however large the
+   input (the template's mask array is read once, and cached; see templateMask).'''
+   d, isnull = templateMask(template_mask)
+   cw, ch = d.meanCellWidth, d.meanCellHeight
+   nodata = arcpy.Raster(in_rast).noDataValue
+   if nodata is None:
+      nodata = 255
+   tiles = []
+   for i, j, h, w, ll, i0, j0, rll, rcols, rrows in blockWindows(d, block):
+      arr = arcpy.RasterToNumPyArray(in_rast, ll, w, h, nodata_to_value=nodata)
+      arr[isnull[i:i + h, j:j + w]] = nodata
+      tile = arcpy.env.scratchGDB + os.sep + 'tmp_blk_' + str(i) + '_' + str(j)
+      arcpy.NumPyArrayToRaster(arr, ll, cw, ch, nodata).save(tile)
+      tiles.append(tile)
+   arcpy.MosaicToNewRaster_management(tiles, os.path.dirname(out_rast), os.path.basename(out_rast), d.spatialReference,
+                                      PIXEL_TYPES[arr.dtype.name], cw, 1)
+   arcpy.SetRasterProperties_management(out_rast, nodata='1 ' + str(nodata))
+   # Value/Count table, as ExtractByMask makes for integer outputs
+   arcpy.BuildRasterAttributeTable_management(out_rast, "OVERWRITE")
+   for t in tiles:
+      arcpy.Delete_management(t)
+   return out_rast
 
 
 def clipNLCD(in_nlcd, out_nlcd, template_mask=None, clip_feature=None, cmap=False):
@@ -19,23 +80,44 @@ def clipNLCD(in_nlcd, out_nlcd, template_mask=None, clip_feature=None, cmap=Fals
    templ = in_nlcd
    # generate name of new file (extracts year by position; update if needed).
    print('Cropping/masking ' + os.path.basename(in_nlcd) + ' to create `' + os.path.basename(out_nlcd) + '`...')
-   # raster mask
-   if template_mask is not None:
-      with arcpy.EnvManager(outputCoordinateSystem=template_mask, snapRaster=template_mask, extent=template_mask, cellSize=template_mask):
-         arcpy.sa.ExtractByMask(in_nlcd, template_mask).save(out_nlcd)
-   else:
-      # Clip from feature.
-      # Headsup: don't use Clip_management. It will resample, even wiwth NO_MAINTAIN_EXTENT. May be a bug/change for Pro 3.1.2.
-      with arcpy.EnvManager(outputCoordinateSystem=templ, extent=clip_feature, snapRaster=templ, cellSize=templ):
-         arcpy.Clip_management(in_nlcd, out_raster=out_nlcd, in_template_dataset=clip_feature,
-                               clipping_geometry="ClippingGeometry", maintain_clipping_extent="NO_MAINTAIN_EXTENT")
-   arcpy.BuildPyramids_management(out_nlcd)
+   # no pyramids or statistics for the clipped raster (or temporary blocks) as it is made; pyramids are built once
+   # at the end
+   with arcpy.EnvManager(pyramid="NONE", rasterStatistics="NONE"):
+      # raster mask
+      if template_mask is not None and sameGrid(in_nlcd, template_mask):
+         # read in blocks, instead of making the masked raster at once
+         extractByMaskBlocks(in_nlcd, template_mask, out_nlcd)
+      elif template_mask is not None:
+         with arcpy.EnvManager(outputCoordinateSystem=template_mask, snapRaster=template_mask, extent=template_mask, cellSize=template_mask):
+            arcpy.sa.ExtractByMask(in_nlcd, template_mask).save(out_nlcd)
+      else:
+         # Clip from feature.
+         # Headsup: don't use Clip_management. It will resample, even wiwth NO_MAINTAIN_EXTENT. May be a bug/change for Pro 3.1.2.
+         with arcpy.EnvManager(outputCoordinateSystem=templ, extent=clip_feature, snapRaster=templ, cellSize=templ):
+            arcpy.Clip_management(in_nlcd, out_raster=out_nlcd, in_template_dataset=clip_feature,
+                                  clipping_geometry="ClippingGeometry", maintain_clipping_extent="NO_MAINTAIN_EXTENT")
+   # nearest neighbor (stated explicitly): keeps land cover codes valid in the pyramids
+   arcpy.BuildPyramids_management(out_nlcd, -1, resample_technique="NEAREST")
    if cmap:
       print("Applying colormap...")
       arcpy.AddColormap_management(out_nlcd, in_nlcd)
    return out_nlcd
 
 
+def extractNLCD(nlcd_folder, z):
+   '''Extracts an NLCD zipfile to its folder, unless the raster is already extracted. Returns the path of the
+   extracted raster (.img), and the names of the files in the zipfile (for removal after processing).'''
+   f = nlcd_folder + os.sep + z.replace('.zip', '') + '.img'
+   with zipfile.ZipFile(nlcd_folder + os.sep + z) as zf:
+      names = [n for n in zf.namelist() if not n.endswith('/')]
+      if not os.path.exists(f):
+         print('Extracting ' + z + '...')
+         t0 = time.time()
+         zf.extractall(nlcd_folder)
+         print('That took ' + str(round((time.time() - t0) / 60, 1)) + ' minutes.')
+   return f, names
+
+
 def main():
    # clip = r'D:\projects\GIS_Data\Reference_Data.gdb\VA_Buff50mi_wgs84'
    template_raster = r'F:\David\GIS_data\NLCD\nlcd_2019\nlcd_2019ed_LandCover_albers.gdb\lc_2001'
@@ -61,9 +143,10 @@ def main():
    
    # Set up patterns
    patterns = [("2021_land_cover_l48", "lc_", lc_gdb), ("2021_impervious_l48", "imperv_", imp_gdb), ('2021_impervious_descriptor_l48', 'impDescriptor_', imp_gdb)]
+   jobs = []
+   flist = os.listdir(nlcd_folder)  # Get a list of all items in the input directory
    for pattern, prefix, out_gdb in patterns:
       # This loops over zipfiles. It will delete extracted files after creating clipped raster.
-      flist = os.listdir(nlcd_folder)  # Get a list of all items in the input directory
       zfiles = [f for f in flist if pattern in f and f.endswith('.zip')]  # This limits the list to zips matching pattern
       for z in zfiles:
          base = z.replace('.zip', '')
@@ -71,20 +154,23 @@ def main():
          if arcpy.Exists(o):
             print('File exists, moving on...')
             continue
-         f = nlcd_folder + os.sep + base + '.img'
-         if not arcpy.Exists(f):
-            print('Extracting ' + z + '...')
-            t0 = time.time()
-            zf = zipfile.ZipFile(nlcd_folder + os.sep + z)
-            zf.extractall(nlcd_folder)
-            print('That took ' + str(round((time.time() - t0) / 60, 1)) + ' minutes.')
+         jobs.append((z, o))
+   
+   # The next zipfile is extracted (in a thread) while the current raster is clipped. Note that this needs disk space
+   # for two extracted rasters at a time.
+   with ThreadPoolExecutor(max_workers=1) as pool:
+      nxt = pool.submit(extractNLCD, nlcd_folder, jobs[0][0]) if jobs else None
+      for k, (z, o) in enumerate(jobs):
+         f, names = nxt.result()
+         if k + 1 < len(jobs):
+            nxt = pool.submit(extractNLCD, nlcd_folder, jobs[k + 1][0])
          # Now process raster
          clipNLCD(f, o, template_mask=template_raster)
    
          print('Removing files...')
-         flist = os.listdir(nlcd_folder)
-         ffiles = [f for f in flist if f.startswith(base) and not f.endswith('.zip')]  # This limits the list to zip files
-         bla = [os.remove(nlcd_folder + os.sep + i) for i in ffiles]
+         # Files to remove are those in the zipfile (and the aux file arcpy may write), so the folder isn't listed again.
+         ffiles = names + [os.path.basename(f) + '.aux.xml']
+         bla = [os.remove(nlcd_folder + os.sep + i) for i in ffiles if os.path.exists(nlcd_folder + os.sep + i)]
 
 
 if __name__ == '__main__':